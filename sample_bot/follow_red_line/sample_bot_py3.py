@@ -201,48 +201,44 @@ class ImageProcessor(object):
 
 
     @staticmethod
-    def _find_best_matched_line(thetaA0, thetaB0, tolerance, vectors, matched = None, start_index = 0):
-        if matched is not None:
-            matched_distance, matched_length, matched_thetaA, matched_thetaB, matched_coord = matched
-            matched_angle = abs(np.pi/2 - matched_thetaB)
-
-        for i in range(start_index, len(vectors)):
-            distance, length, thetaA, thetaB, coord = vectors[i]
-
-            if (thetaA0 is None or abs(thetaA - thetaA0) <= tolerance) and \
-               (thetaB0 is None or abs(thetaB - thetaB0) <= tolerance):
-                
-                if matched is None:
-                    matched = vectors[i]
-                    matched_distance, matched_length, matched_thetaA, matched_thetaB, matched_coord = matched
-                    matched_angle = abs(np.pi/2 - matched_thetaB)
-                    continue
-
-                heading_angle = abs(np.pi/2 - thetaB)
-
-                if heading_angle > matched_angle:
-                    continue
-                if heading_angle < matched_angle:
-                    matched = vectors[i]
-                    matched_distance, matched_length, matched_thetaA, matched_thetaB, matched_coord = matched
-                    matched_angle = abs(np.pi/2 - matched_thetaB)
-                    continue
-                if distance < matched_distance:
-                    continue
-                if distance > matched_distance:
-                    matched = vectors[i]
-                    matched_distance, matched_length, matched_thetaA, matched_thetaB, matched_coord = matched
-                    matched_angle = abs(np.pi/2 - matched_thetaB)
-                    continue
-                if length < matched_length:
-                    continue
-                if length > matched_length:
-                    matched = vectors[i]
-                    matched_distance, matched_length, matched_thetaA, matched_thetaB, matched_coord = matched
-                    matched_angle = abs(np.pi/2 - matched_thetaB)
-                    continue
-
-        return matched
+    def _line_vectors(lines, camera_x, camera_y):
+        # distance to the camera, length, slope angle (thetaA) and heading angle (thetaB) of every
+        # Hough segment as arrays, sorted by the shortest distance first and the longer length next
+        coords   = lines.reshape(-1, 4)
+        x1, y1, x2, y2 = coords.astype(np.float64).T
+
+        thetaA   = np.arctan2(np.abs(y2 - y1), (x2 - x1))
+        thetaB1  = np.arctan2(np.abs(y1 - camera_y), (x1 - camera_x))
+        thetaB2  = np.arctan2(np.abs(y2 - camera_y), (x2 - camera_x))
+        thetaB   = np.where(np.abs(np.pi/2 - thetaB1) < np.abs(np.pi/2 - thetaB2), thetaB1, thetaB2)
+
+        length   = np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+        distance = np.minimum(np.sqrt((x1 - camera_x) ** 2 + (y1 - camera_y) ** 2),
+                              np.sqrt((x2 - camera_x) ** 2 + (y2 - camera_y) ** 2))
+
+        order    = np.lexsort((-length, distance))
+        return distance[order], length[order], thetaA[order], thetaB[order], coords[order]
+
+
+    @staticmethod
+    def _find_best_matched_line(thetaA0, thetaB0, tolerance, vectors):
+        # index of the line within the tolerance of thetaA0/thetaB0 heading the most straight ahead,
+        # then the farther and the longer one, the first one in order on a tie, None if no line matches
+        distance, length, thetaA, thetaB, coords = vectors
+        matched = np.ones(len(distance), dtype=bool)
+
+        if thetaA0 is not None:
+            matched &= np.abs(thetaA - thetaA0) <= tolerance
+        if thetaB0 is not None:
+            matched &= np.abs(thetaB - thetaB0) <= tolerance
+
+        candidates = np.nonzero(matched)[0]
+        if len(candidates) == 0:
+            return None
+
+        heading_angle = np.abs(np.pi/2 - thetaB[candidates])
+        best = np.lexsort((candidates, -length[candidates], -distance[candidates], heading_angle))[0]
+        return candidates[best]
 
 
     @staticmethod
@@ -257,34 +253,19 @@ class ImageProcessor(object):
         image_width  = img.shape[1]
         camera_x     = image_width / 2
         camera_y     = image_height
-        vectors      = []
-
-        for line in lines:
-            for x1, y1, x2, y2 in line:
-                thetaA   = math.atan2(abs(y2 - y1), (x2 - x1))
-                thetaB1  = math.atan2(abs(y1 - camera_y), (x1 - camera_x))
-                thetaB2  = math.atan2(abs(y2 - camera_y), (x2 - camera_x))
-                thetaB   = thetaB1 if abs(np.pi/2 - thetaB1) < abs(np.pi/2 - thetaB2) else thetaB2
-
-                length   = math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-                distance = min(math.sqrt((x1 - camera_x) ** 2 + (y1 - camera_y) ** 2),
-                               math.sqrt((x2 - camera_x) ** 2 + (y2 - camera_y) ** 2))
-
-                vectors.append((distance, length, thetaA, thetaB, (x1, y1, x2, y2)))
+        vectors      = ImageProcessor._line_vectors(lines, camera_x, camera_y)
+        distance, length, thetaA, thetaB, coords = vectors
 
-                if debug:
-                    # draw the edges
-                    cv2.line(img, (x1, y1), (x2, y2), (255, 255, 0), 2)
-
-        #the line of the shortest distance and longer length will be the first choice
-        vectors.sort(lambda a, b: cmp(a[0], b[0]) if a[0] != b[0] else -cmp(a[1], b[1]))
+        if debug:
+            # draw the edges
+            cv2.polylines(img, coords.reshape(-1, 2, 2).astype(np.int32), False, (255, 255, 0), 2)
 
-        best = vectors[0]
-        best_distance, best_length, best_thetaA, best_thetaB, best_coord = best
+        #the line of the shortest distance and longer length is the first choice, the best one is
+        #picked among the lines of similar slope
         tolerance = np.pi / 180.0 * 10.0
-
-        best = ImageProcessor._find_best_matched_line(best_thetaA, None, tolerance, vectors, matched = best, start_index = 1)
-        best_distance, best_length, best_thetaA, best_thetaB, best_coord = best
+        best      = ImageProcessor._find_best_matched_line(thetaA[0], None, tolerance, vectors)
+        best_thetaA, best_thetaB = thetaA[best], thetaB[best]
+        best_coord = tuple(int(c) for c in coords[best])
 
         if debug:
             #draw the best line
@@ -302,14 +283,14 @@ class ImageProcessor(object):
 
                 if debug:
                     #draw the last possible line
-                    cv2.line(img, (left_x, left_y), (camera_x, camera_y), (255, 128, 128), 2)
+                    cv2.line(img, (left_x, left_y), (int(camera_x), camera_y), (255, 128, 128), 2)
                     cv2.line(img, (left_x, left_y), (best_x1, best_y1), (255, 128, 128), 2)
             else:
                 best_thetaC = math.atan2(abs(right_y - camera_y), (right_x - camera_x))
 
                 if debug:
                     #draw the last possible line
-                    cv2.line(img, (right_x, right_y), (camera_x, camera_y), (255, 128, 128), 2)
+                    cv2.line(img, (right_x, right_y), (int(camera_x), camera_y), (255, 128, 128), 2)
                     cv2.line(img, (right_x, right_y), (best_x1, best_y1), (255, 128, 128), 2)
 
             steering_angle = best_thetaC
@@ -319,8 +300,8 @@ class ImageProcessor(object):
         if (steering_angle - np.pi/2) * (last_steering_angle - np.pi/2) < 0:
             last = ImageProcessor._find_best_matched_line(None, last_steering_angle, tolerance, vectors)
 
-            if last:
-                last_distance, last_length, last_thetaA, last_thetaB, last_coord = last
+            if last is not None:
+                last_thetaB, last_coord = thetaB[last], tuple(int(c) for c in coords[last])
                 steering_angle = last_thetaB
 
                 if debug:
@@ -330,9 +311,9 @@ class ImageProcessor(object):
         if debug:
             #draw the steering direction
             r = 60
-            x = image_width / 2 + int(r * math.cos(steering_angle))
-            y = image_height    - int(r * math.sin(steering_angle))
-            cv2.line(img, (image_width / 2, image_height), (x, y), (255, 0, 255), 2)
+            x = image_width // 2 + int(r * math.cos(steering_angle))
+            y = image_height     - int(r * math.sin(steering_angle))
+            cv2.line(img, (image_width // 2, image_height), (x, y), (255, 0, 255), 2)
             logit("line angle: %0.2f, steering angle: %0.2f, last steering angle: %0.2f" % (ImageProcessor.rad2deg(best_thetaA), ImageProcessor.rad2deg(np.pi/2-steering_angle), ImageProcessor.rad2deg(np.pi/2-last_steering_angle)))
 
         return (np.pi/2 - steering_angle)
@@ -362,9 +343,9 @@ class ImageProcessor(object):
         if debug:
             #draw the steering direction
             r = 60
-            x = image_width / 2 + int(r * math.cos(steering_angle))
-            y = image_height    - int(r * math.sin(steering_angle))
-            cv2.line(img, (image_width / 2, image_height), (x, y), (255, 0, 255), 2)
+            x = image_width // 2 + int(r * math.cos(steering_angle))
+            y = image_height     - int(r * math.sin(steering_angle))
+            cv2.line(img, (image_width // 2, image_height), (x, y), (255, 0, 255), 2)
 
         return (np.pi/2 - steering_angle) * 2.0
 
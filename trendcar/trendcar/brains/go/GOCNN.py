@@ -1,30 +1,111 @@
 import os,sys
 import cv2
 import numpy as np
-from tensorflow.keras.models import load_model 
+#
+def load_interpreter(model_path):
+  # TFLite interpreter, from the standalone tflite_runtime when available so
+  # full TensorFlow does not have to be imported on the car
+  try:
+    from tflite_runtime.interpreter import Interpreter
+  except ImportError:
+    import tensorflow as tf
+    Interpreter = tf.lite.Interpreter
+  interpreter = Interpreter(model_path=model_path)
+  interpreter.allocate_tensors()
+  return interpreter
+#
+def export_tflite(model_path, representative_patches, output_path=None):
+  """
+  Convert a Keras ".h5" CNN into a fully int8 quantized TFLite flatbuffer taking
+  uint8 patches as input, `representative_patches` are uint8 image patches used to
+  calibrate the activation ranges. Requires TensorFlow.
+  """
+  import tensorflow as tf
+  if output_path is None:
+    output_path = os.path.splitext(model_path)[0] + '.tflite'
+  model = tf.keras.models.load_model(model_path)
+  def representative_dataset():
+    for patch in representative_patches:
+      yield [np.array(patch, dtype=np.float32, ndmin=4)/255]
+  converter = tf.lite.TFLiteConverter.from_keras_model(model)
+  converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  converter.representative_dataset = representative_dataset
+  converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+  converter.inference_input_type  = tf.uint8
+  converter.inference_output_type = tf.uint8
+  with open(output_path, 'wb') as fp:
+    fp.write(converter.convert())
+  return output_path
 #
 class CNN:
   def msg_print(self, msg):
     sys.stderr.write('[CNN4GO] {}\n'.format(msg))
   #
   def __init__(self, model_path=None):
+    self.model = None
+    self.interpreter = None
     if model_path is not None:
       self.load_model(model_path)
   #
   def load_model(self,model_path):
+    # A ".tflite" export next to the ".h5" model is preferred, it runs without TensorFlow
     try:
-      self.model = load_model(model_path)
-      self.msg_print('Model loaded')
+      tflite_path = os.path.splitext(model_path)[0] + '.tflite'
+      if os.path.exists(tflite_path):
+        self.interpreter = load_interpreter(tflite_path)
+        self.msg_print('TFLite model loaded')
+      else:
+        from tensorflow.keras.models import load_model
+        self.model = load_model(model_path)
+        self.msg_print('Model loaded')
       return True
     except Exception as e:
       self.msg_print('Unable to load model:"{}", reason:{}'.format(\
           model_path, str(e)))
-      return False 
+      return False
+  #
+  def tflite_predict(self, image_samples):
+    samples = np.asarray(image_samples, dtype=np.uint8)
+    input_detail  = self.interpreter.get_input_details()[0]
+    output_detail = self.interpreter.get_output_details()[0]
+    if tuple(input_detail['shape']) != samples.shape:
+      self.interpreter.resize_tensor_input(input_detail['index'], samples.shape)
+      self.interpreter.allocate_tensors()
+    # Quantize the inputs, the model was trained on pixel/255
+    scale, zero_point = input_detail['quantization']
+    if input_detail['dtype'] == np.float32:
+      inputs = samples.astype(np.float32)/255
+    elif abs(scale*255 - 1) < 1e-6:
+      inputs = (samples.astype(np.int16) + zero_point).astype(input_detail['dtype'])
+    else:
+      info = np.iinfo(input_detail['dtype'])
+      inputs = np.clip(np.round(samples/(255*scale)) + zero_point, info.min, info.max).astype(input_detail['dtype'])
+    self.interpreter.set_tensor(input_detail['index'], inputs)
+    self.interpreter.invoke()
+    outputs = self.interpreter.get_tensor(output_detail['index'])
+    scale, zero_point = output_detail['quantization']
+    if output_detail['dtype'] != np.float32:
+      outputs = (outputs.astype(np.float32) - zero_point) * scale
+    return outputs
   #
   def batch_predict(self,image_samples):
+    if self.interpreter is not None:
+      return self.tflite_predict(image_samples)
     normalized = np.array(image_samples, dtype=np.float32)/255
     return self.model.predict_proba(normalized)
   #
   def predict(self, image_sample):
+    if self.interpreter is not None:
+      return self.tflite_predict(np.array(image_sample, dtype=np.uint8, ndmin=4))
     normalized = np.array(image_sample, dtype=np.float32, ndmin=4)/255
     return self.model.predict_proba(normalized)
+#
+if __name__ == '__main__':
+  from glob import glob
+  if len(sys.argv) not in (3, 4):
+    sys.stderr.write('Usage: {} <model.h5> <representative patch folder> [output.tflite]\n'.format(sys.argv[0]))
+    sys.exit(1)
+  patches = [cv2.imread(path) for path in sorted(glob(os.path.join(sys.argv[2], '*')))]
+  patches = [cv2.resize(patch, (40, 20)) for patch in patches if patch is not None]
+  output_path = export_tflite(sys.argv[1], patches, sys.argv[3] if len(sys.argv) == 4 else None)
+  sys.stderr.write('Exported {} to {}\n'.format(sys.argv[1], output_path))
@@ -0,0 +1,150 @@
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import numpy as np
+from pickle import load
+#
+#
+class CompiledForest:
+  """
+  Flat array form of a fitted sklearn RandomForestClassifier. The nodes of every
+  tree are concatenated into feature/threshold/left/right arrays and predict_proba()
+  walks all the trees for a whole batch at once with NumPy only, giving the same
+  probabilities as the sklearn forest bit for bit.
+  """
+  def __init__(self, feature, threshold, left, right, value, roots, depth, classes):
+    self.feature   = feature    # split feature of each node (0 for leaves)
+    self.threshold = threshold  # split threshold of each node
+    self.left      = left       # global index of the left child, leaves point to themselves
+    self.right     = right      # global index of the right child, leaves point to themselves
+    self.value     = value      # normalized class probabilities of each node
+    self.roots     = roots      # global index of the root node of each tree
+    self.depth     = int(depth) # maximum depth over all trees
+    self.classes_  = classes
+  #
+  def predict_proba(self, X):
+    X = np.asarray(X, dtype=np.float32) # sklearn trees compare float32 features
+    rows = np.arange(X.shape[0])[:, np.newaxis]
+    node = np.tile(self.roots, (X.shape[0], 1))
+    for _ in range(self.depth):
+      go_left = X[rows, self.feature[node]] <= self.threshold[node]
+      node = np.where(go_left, self.left[node], self.right[node])
+    # Accumulate tree by tree like sklearn does, to keep the rounding identical
+    proba = np.zeros((X.shape[0], self.value.shape[1]))
+    for tree in range(len(self.roots)):
+      proba += self.value[node[:, tree]]
+    proba /= len(self.roots)
+    return proba
+  #
+  def predict(self, X):
+    return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+  #
+  def save(self, path):
+    with open(path, 'wb') as fp:
+      np.savez(fp, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+               value=self.value, roots=self.roots, depth=self.depth, classes=self.classes_)
+  #
+  @staticmethod
+  def load(path):
+    with np.load(path, allow_pickle=False) as data:
+      return CompiledForest(data['feature'], data['threshold'], data['left'], data['right'],
+                            data['value'], data['roots'], data['depth'], data['classes'])
+#
+def export_forest(clf):
+  # Convert a fitted sklearn forest of classification trees into a CompiledForest
+  if getattr(clf, 'n_outputs_', 1) != 1:
+    raise ValueError('Only single-output forests are supported')
+
+  # sklearn before 1.4 keeps class counts in the tree values and normalizes them when
+  # predicting, later versions keep the class fractions and use them as they are
+  import sklearn
+  normalize = tuple(int(v) for v in sklearn.__version__.split('.')[:2]) < (1, 4)
+  n_classes = int(clf.n_classes_)
+  features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+  offset, depth = 0, 0
+  for estimator in clf.estimators_:
+    tree = estimator.tree_
+    is_leaf = tree.children_left == -1
+    index = np.arange(tree.node_count) + offset
+    features.append(np.where(is_leaf, 0, tree.feature))
+    thresholds.append(np.where(is_leaf, 0.0, tree.threshold))
+    lefts.append(np.where(is_leaf, index, tree.children_left + offset))
+    rights.append(np.where(is_leaf, index, tree.children_right + offset))
+    # Same normalization as DecisionTreeClassifier.predict_proba()
+    value = tree.value[:, 0, :n_classes].astype(np.float64)
+    if normalize:
+      normalizer = value.sum(axis=1)[:, np.newaxis]
+      normalizer[normalizer == 0.0] = 1.0
+      value = value / normalizer
+    values.append(value)
+    roots.append(offset)
+    depth = max(depth, tree.max_depth)
+    offset += tree.node_count
+
+  return CompiledForest(np.concatenate(features).astype(np.intp),
+                        np.concatenate(thresholds).astype(np.float64),
+                        np.concatenate(lefts).astype(np.intp),
+                        np.concatenate(rights).astype(np.intp),
+                        np.concatenate(values),
+                        np.array(roots, dtype=np.intp),
+                        depth,
+                        np.asarray(clf.classes_))
+#
+def load_model(filepath):
+  # Unpickle a sklearn model, this requires sklearn
+  if filepath.endswith('.joblib'):
+    from joblib import load as joblib_load
+    return joblib_load(filepath)
+  try:
+    with open(filepath,'rb') as fp:
+      return load(fp)
+  except UnicodeDecodeError:
+    with open(filepath,'rb') as fp:
+      return load(fp, encoding='latin1')
+#
+def check_forest(clf, forest, n_samples=1000, seed=0):
+  """
+  Compare the probabilities of a CompiledForest with the sklearn forest it was exported
+  from on random features spread around the split thresholds, raising an AssertionError
+  unless they are bit identical.
+  """
+  n_features = getattr(clf, 'n_features_in_', None) or clf.n_features_ # older sklearn only has n_features_
+  split = forest.left != np.arange(len(forest.left))
+  low, high = np.zeros(n_features), np.ones(n_features)
+  for f in np.unique(forest.feature[split]):
+    thresholds = forest.threshold[split & (forest.feature == f)]
+    low[f], high[f] = thresholds.min() - 1.0, thresholds.max() + 1.0
+  X = np.random.RandomState(seed).uniform(low, high, (n_samples, len(low))).astype(np.float32)
+  expected, actual = clf.predict_proba(X), forest.predict_proba(X)
+  assert expected.shape == actual.shape and np.array_equal(expected, actual), \
+    'compiled forest differs from sklearn on {} of {} samples'.format(int(np.any(expected != actual, axis=1).sum()), n_samples)
+#
+def load_forest(filepath):
+  """
+  Load a CompiledForest from a ".npz" file, or from the ".npz" exported next to a
+  pickled sklearn model when it exists and is up to date (see __main__). Otherwise
+  the sklearn model is loaded and compiled in memory, which requires sklearn.
+  """
+  compiled_path = os.path.splitext(filepath)[0] + '.npz'
+  if filepath.endswith('.npz'):
+    return CompiledForest.load(filepath)
+  if os.path.exists(compiled_path) and os.path.getmtime(compiled_path) >= os.path.getmtime(filepath):
+    return CompiledForest.load(compiled_path)
+  return export_forest(load_model(filepath))
+#
+if __name__ == '__main__':
+  # Export a pickled sklearn model to the ".npz" load_forest() picks up, after checking
+  # the compiled probabilities are bit identical to the sklearn ones
+  if len(sys.argv) not in (2, 3):
+    print('Usage: {} <model.pkl|model.joblib> [output.npz]'.format(sys.argv[0]), file=sys.stderr)
+    sys.exit(1)
+
+  output = sys.argv[2] if len(sys.argv) == 3 else os.path.splitext(sys.argv[1])[0] + '.npz'
+  clf = load_model(sys.argv[1])
+  forest = export_forest(clf)
+  check_forest(clf, forest)
+  forest.save(output)
+  check_forest(clf, CompiledForest.load(output))
+  print('Exported {} to {}'.format(sys.argv[1], output))
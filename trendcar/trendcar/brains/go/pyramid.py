@@ -0,0 +1,21 @@
+import cv2
+#
+#
+class ImagePyramid:
+  """
+  Gaussian pyramid of one frame, level 0 is the frame itself and every next level
+  is cv2.pyrDown() of the previous one. Levels are built on first use and cached,
+  so every stage working on the same frame shares them.
+  """
+  def __init__(self, img):
+    self.levels = [img]
+  #
+  def level(self, n):
+    while len(self.levels) <= n:
+      self.levels.append(cv2.pyrDown(self.levels[-1]))
+    return self.levels[n]
+  #
+  def scale(self, n):
+    # Factor mapping level n coordinates back to level 0
+    return 2 ** n
+#
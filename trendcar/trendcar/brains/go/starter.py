@@ -4,11 +4,10 @@ from __future__ import division
 import cv2
 import numpy as np
 from .GOCNN import CNN
+from .pyramid import ImagePyramid
+from .temporal import RunningAverage
+from .window import find_candidates, non_max_suppression, scale_rects
 from collections import deque
-from sys import version
-#
-if version > '3':
-    from functools import reduce
 #
 class detect_go:
   def get_roi_mask(self, f, cut_upper=True):
@@ -26,62 +25,59 @@ class detect_go:
   def msg_print(self, msg):
     print('[Go Detection] {}'.format(msg))
   #
+  def search(self, f):
+    # Candidate windows of one frame, positive ones with their GO probabilities
+    mask, roi = self.get_roi_mask(f, False)
+    img_rect = find_candidates(mask, self.window_size, self.stride, self.roi_ratio)
+    if len(img_rect)==0:
+      return img_rect, [], []
+
+    img_patches = [f[top:bottom, left:right] for top, bottom, left, right in img_rect]
+    pred_prob = np.asarray(self.cnn.batch_predict(img_patches))
+    positive_idx = np.nonzero(pred_prob[:,1]>0.95)[0]
+    return img_rect, [img_rect[idx] for idx in positive_idx], pred_prob[positive_idx,1]
+  #
   def detect(self,img):
 
 
     # Make sure the incoming image is good.
     if img is None: return False, []
     if img.shape[0] == 0 or img.shape[1] == 0: return False, []
-    self.img_queue.append(img)
+    self.img_queue.append(img[:img.shape[0]*2//5])
 
-    # Averaging images
-    f = self.img_queue[0].astype(np.float32)
-    for i,x in enumerate(list(self.img_queue)[1:]):
-      f += x.astype(np.float32)
-    f/=len(self.img_queue)
-    f = f.astype(np.uint8)
+    # Averaging images, only the upper 2/5 is used
+    pyramid = ImagePyramid(self.img_queue.mean())
 
-    # Get Red color space
-    mask, roi = self.get_roi_mask(f, True)
-    img_patches, img_rect = [], []
-    _h,_w,_c = roi.shape
-    for wi, window in enumerate(self.window_size):
-      for h in range(0, _h - window[0], self.stride[wi][0]):
-        for w in range(0, _w - window[1], self.stride[wi][1]):
-          _bottom, _right = h+window[0], w+window[1]
-          mask_patch = mask[h:_bottom, w:_right]
-          shape = mask_patch.shape
-          if shape[0]==0 or shape[1]==0: continue
-          img_patch = f[h:_bottom, w:_right]
-          _roi_ratio = np.count_nonzero(mask_patch)/reduce(lambda x,y: x*y,shape,1.0)
-          if _roi_ratio > self.roi_ratio[0] and _roi_ratio < self.roi_ratio[1]:
-            if img_patch.shape[0] == window[0] and img_patch.shape[1] == window[1]:
-              img_patches.append(img_patch)
-              img_rect.append((h,_bottom,w,_right))    
-    # 
+    # Search every pyramid level, rects are mapped back to the full resolution
+    img_rect, positive_position, positive_scores = [], [], []
     try:
-      if len(img_patches)!=0:
-        pred_prob = self.cnn.batch_predict(img_patches)
-        positive_candidates = [list(filter(lambda x: x[1][1]>0.95 ,enumerate(pred_prob)))]
-        positive_position = list(map(lambda x: img_rect[x[0]],filter(lambda x: x[1][1]>0.95 ,enumerate(pred_prob))))
-      else: return False, img_rect
+      for level in self.pyramid_levels:
+        scale = pyramid.scale(level)
+        level_rect, level_positive, level_scores = self.search(pyramid.level(level))
+        img_rect.extend(scale_rects(level_rect, scale))
+        positive_position.extend(scale_rects(level_positive, scale))
+        positive_scores.extend(level_scores)
+      if len(img_rect)==0: return False, img_rect
     except Exception as e:
       self.msg_print('Fail to do CNN prediction, reason: {}'.format(str(e)))
       return False, img_rect
     #
-    self.detection_cnt.append(len(positive_candidates[0]))
+    self.detection_cnt.append(len(positive_position))
     #
     _acc = np.sum(self.detection_cnt)
     if _acc > self.MINIMUM_ACCU_NUM_OF_DETECTION:
       self.msg_print('Detect GO num#{}'.format(_acc))
-      return True, positive_position
+      # Overlapping hits of the same light across positions and scales are merged
+      keep = non_max_suppression(positive_position, positive_scores, self.nms_overlap)
+      return True, [positive_position[idx] for idx in keep]
     return False, img_rect
   #
   def __init__(self, \
                cnn_model_path = './go_models/go_cnn_32.h5',\
                min_image_cnt = 5,\
                min_detection_cnt = 10,\
-               min_detection_mul = 2):
+               min_detection_mul = 2,\
+               pyramid_levels = (0,)):
     #
     try:
       self.cnn = CNN()
@@ -97,9 +93,11 @@ class detect_go:
     self.window_size = [(20,40)] # (Height, Width)
     self.stride = [(5,5)]            # Sliding Window stride
     self.roi_ratio = (0.05, 0.5)                 # ROI Ratio
+    self.pyramid_levels = pyramid_levels        # Pyramid levels searched, each halves the resolution
+    self.nms_overlap = 0.3                       # Maximum overlap (IoU) of the merged detections
     self.detection_cnt = deque([], min_image_cnt)  # List of detection count.
     self.MINIMUM_IMAGE_QUEUE_SIZE = min_image_cnt  # Minimum number of images required 
-    self.img_queue = deque([], self.MINIMUM_IMAGE_QUEUE_SIZE)
+    self.img_queue = RunningAverage(self.MINIMUM_IMAGE_QUEUE_SIZE)
     self.MINIMUM_ACCU_NUM_OF_DETECTION = min_image_cnt*min_detection_mul # Number of multiplier to calculate the minimum count of detection
     
 #
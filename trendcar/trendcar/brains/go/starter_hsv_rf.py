@@ -2,10 +2,17 @@ import os
 import cv2
 import numpy as np
 from collections import deque
-from sys import version
-from time import time
-from pickle import load
 #
+try:
+  from .forest import load_forest
+  from .pyramid import ImagePyramid
+  from .temporal import MotionGate, RunningAverage
+  from .window import find_candidates, histogram_integral, mask_integral, non_max_suppression, rect_sums, scale_rects
+except ImportError:   # run standalone from this directory, as _go_hsv_rf.py does
+  from forest import load_forest
+  from pyramid import ImagePyramid
+  from temporal import MotionGate, RunningAverage
+  from window import find_candidates, histogram_integral, mask_integral, non_max_suppression, rect_sums, scale_rects
 #
 class detect_go:
   #
@@ -13,6 +20,23 @@ class detect_go:
     hist_hsv = map(lambda x: cv2.calcHist([hsv_img],[x[0]],None,[x[1]],[0,256]),enumerate(hsv_hist_bins))
     return np.vstack(hist_hsv)
   #
+  def generate_hsv_hist_fea_batch(self, hsv_img, rects, hsv_hist_bins = [18,8,10]):
+    # Same features as generate_hsv_hist_fea() for every rect of hsv_img, one row per rect
+    integral = histogram_integral(hsv_img, hsv_hist_bins)
+    top, bottom, left, right = np.array(rects).T
+    return rect_sums(integral, top, bottom, left, right).astype(np.float32)
+  #
+  def verify_boundaries(self, hsv_img, rects, margin = 2, dark_thres = 40, min_dark_ratio = 0.40):
+    # Whether enough pixels within `margin` of each rect border are dark, with
+    # the dark pixels counted as the outer box minus the inner box sums
+    gray = cv2.cvtColor(cv2.cvtColor(hsv_img, cv2.COLOR_HSV2RGB), cv2.COLOR_RGB2GRAY)
+    integral = mask_integral(gray < dark_thres)
+    top, bottom, left, right = np.asarray(rects).T
+    outer = rect_sums(integral, top, bottom, left, right)
+    inner = rect_sums(integral, top + margin, bottom - margin, left + margin, right - margin)
+    boundary_area = (bottom - top) * (right - left) - (bottom - top - 2 * margin) * (right - left - 2 * margin)
+    return (outer - inner) / boundary_area.astype(np.float64) >= min_dark_ratio
+  #
   def get_roi_mask(self, f, cut_upper=True):
     shape = f.shape
     if cut_upper:
@@ -28,77 +52,57 @@ class detect_go:
   def msg_print(self, msg):
     print('[Go Detection] {}'.format(msg))
   #
+  def search(self, f):
+    # Candidate windows of one frame, positive and verified ones with their GO probabilities
+    mask, roi, hsv_space = self.get_roi_mask(f, False)
+    img_rect = find_candidates(mask, self.window_size, self.stride, self.roi_ratio)
+    if len(img_rect)==0:
+      return img_rect, [], []
+
+    features = self.generate_hsv_hist_fea_batch(hsv_space, img_rect)
+    pred_prob = self.clf.predict_proba(features)
+    positive_idx = np.nonzero(pred_prob[:,0]>=0.9)[0]
+
+    # 2nd verification for positive candidates
+    if len(positive_idx)!=0:
+      positive_rect = np.array(img_rect)[positive_idx]
+      positive_idx = positive_idx[self.verify_boundaries(hsv_space, positive_rect)]
+    return img_rect, [img_rect[idx] for idx in positive_idx], pred_prob[positive_idx,0]
+  #
   def detect(self,img):
 
     # Make sure the incoming image is good.
     if img is None: return False, []
     if img.shape[0] == 0 or img.shape[1] == 0: return False, []
-    self.img_queue.append(img)
+    # One pyramid of the upper half per frame, shared by the motion gate and the
+    # running averages of the searched levels
+    pyramid = ImagePyramid(img[:img.shape[0]*1//2])
+    for level in self.pyramid_levels:
+      self.img_queues[level].append(pyramid.level(level))
+    self.motion_gate.append(pyramid)
 
     # If image queue are not full then force skipping current frame.
-    if len(self.img_queue)<self.MINIMUM_IMAGE_QUEUE_SIZE:
+    if len(self.motion_gate)<self.MINIMUM_IMAGE_QUEUE_SIZE:
       return False, []
 
-    # Averaging images
-    f = self.img_queue[0].astype(np.float32)
-    for i,x in enumerate(list(self.img_queue)[1:]):
-      f += x.astype(np.float32)
-    f/=len(self.img_queue)
-    f = f.astype(np.uint8)
-
-    # Frame differencing
-    _h, _w, _c = f.shape
-    _diff = np.abs(cv2.cvtColor(f, cv2.COLOR_RGB2GRAY)[:int(_h*1/2)].astype(np.float32) - \
-                   cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)[:int(_h*1/2)].astype(np.float32)).astype(np.uint8)
-    _diff_d = np.sum(_diff)/float(_diff.shape[0]*_diff.shape[1]*256)
-    
-    # 5% of pixel intensity are greater than before
-    if _diff_d > 0.05:  
-      self.img_queue.clear()
+    # Frame differencing on a low resolution grayscale level
+    # Mean intensity change above motion_threshold of the full range
+    if self.motion_gate.update() > self.motion_threshold:
+      for img_queue in self.img_queues.values():
+        img_queue.clear()
+      self.motion_gate.clear()
       return False, [] 
 
-    # Get Red color space
-    mask, roi, hsv_space = self.get_roi_mask(f, True)
-    img_patches, img_rect = [], []
-    _h,_w,_c = roi.shape
-    for wi, window in enumerate(self.window_size):
-      for h in range(0, _h - window[0], self.stride[wi][0]):
-        for w in range(0, _w - window[1], self.stride[wi][1]):
-          _bottom, _right = h+window[0], w+window[1]
-          mask_patch = mask[h:_bottom, w:_right]
-          shape = mask_patch.shape
-          if shape[0]==0 or shape[1]==0: continue
-          img_patch = hsv_space[h:_bottom, w:_right]
-          _roi_ratio = np.count_nonzero(mask_patch)/float(shape[0]*shape[1])
-          if _roi_ratio > self.roi_ratio[0] and _roi_ratio < self.roi_ratio[1]:
-            if img_patch.shape[0] == window[0] and img_patch.shape[1] == window[1]:
-              img_patches.append(img_patch)
-              img_rect.append((h,_bottom,w,_right))    
-    # 
-    margin = 2
-    dbl_margin = margin * 2
-    real_candidates = []
+    # Search the averaged images of every pyramid level, rects are mapped back to the full resolution
+    img_rect, real_candidates, real_scores = [], [], []
     try:
-      if len(img_patches)!=0:
-        features = np.vstack(map(lambda x: self.generate_hsv_hist_fea(x).transpose(), img_patches))
-        pred_prob = self.clf.predict_proba(features)
-
-        positive_candidates = [list(filter(lambda x: x[1][0]>=0.9 ,enumerate(pred_prob)))]
-        positive_position = list(map(lambda x: img_rect[x[0]],filter(lambda x: x[1][0]>=0.9 ,enumerate(pred_prob))))
-
-        # 2nd verification for positive candidates
-        real_candidates = []
-        for (idx, prob) in positive_candidates[0]:
-          _target = cv2.cvtColor(cv2.cvtColor(img_patches[idx], cv2.COLOR_HSV2RGB), cv2.COLOR_RGB2GRAY)
-          _h, _w = _target.shape
-          mask_area = (_h - dbl_margin) * (_w - dbl_margin)
-          boundary_area = _h*_w - mask_area
-          _target[margin:_h-margin, margin: _w-margin] = 255
-          _boundaries_num = _target[_target < 40].size
-          if _boundaries_num/float(boundary_area) >= 0.40:
-            real_candidates.append(img_rect[idx])
-        #
-      else: return False, img_rect
+      for level in self.pyramid_levels:
+        scale = pyramid.scale(level)
+        level_rect, level_candidates, level_scores = self.search(self.img_queues[level].mean())
+        img_rect.extend(scale_rects(level_rect, scale))
+        real_candidates.extend(scale_rects(level_candidates, scale))
+        real_scores.extend(level_scores)
+      if len(img_rect)==0: return False, img_rect
     except Exception as e:
       self.msg_print('Fail to do model inference, reason: {}'.format(str(e)))
       return False, img_rect
@@ -108,24 +112,23 @@ class detect_go:
     _acc = np.sum(self.detection_cnt)
     if _acc > self.MINIMUM_ACCU_NUM_OF_DETECTION:
       self.msg_print('Detect GO num#{}'.format(_acc))
-      return True, real_candidates
+      # Overlapping hits of the same light across positions and scales are merged
+      keep = non_max_suppression(real_candidates, real_scores, self.nms_overlap)
+      return True, [real_candidates[idx] for idx in keep]
     return False, img_rect
   #
   def __init__(self, \
                model_path = './go_models/1.0.8_hsv_hist_rf_32.pkl',\
                min_image_cnt = 2,\
                min_detection_cnt = 15,\
-               min_detection_mul = 0.5):
+               min_detection_mul = 0.5,\
+               pyramid_levels = (0,),\
+               motion_threshold = 0.045):
     #
     try:
       self.msg_print('Loading "GO" model...')
       filepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), model_path)
-      try:
-        with open(filepath,'rb') as fp:
-          self.clf = load(fp)
-      except UnicodeDecodeError:
-        with open(filepath,'rb') as fp:
-          self.clf = load(fp, encoding='latin1')
+      self.clf = load_forest(filepath)
       self.msg_print('Done')
     except Exception as e:
       self.msg_print('Fail to load "go" model... Initialization failed')
@@ -136,10 +139,14 @@ class detect_go:
     self.window_size = [(20,40)] # (Height, Width)
     self.stride = [(3,3)]            # Sliding Window stride
     self.roi_ratio = (0.1, 0.6)                 # ROI Ratio
+    self.pyramid_levels = pyramid_levels       # Pyramid levels searched, each halves the resolution
+    self.nms_overlap = 0.3                      # Maximum overlap (IoU) of the merged detections
     self.detection_cnt = deque([], min_image_cnt)  # List of detection count.
     self.detected_rect = deque([], min_image_cnt)  # 
     self.MINIMUM_IMAGE_QUEUE_SIZE = min_image_cnt  # Minimum number of images required 
-    self.img_queue = deque([], self.MINIMUM_IMAGE_QUEUE_SIZE)
+    self.img_queues = dict((level, RunningAverage(self.MINIMUM_IMAGE_QUEUE_SIZE)) for level in pyramid_levels)  # Averaged frames of every searched level
+    self.motion_gate = MotionGate(self.MINIMUM_IMAGE_QUEUE_SIZE)  # Scene change score of the latest frame
+    self.motion_threshold = motion_threshold   # Motion score skipping the search, calibrated for level 2 (see MotionGate)
     self.MINIMUM_ACCU_NUM_OF_DETECTION = min_image_cnt*min_detection_mul # Number of multiplier to calculate the minimum count of detection
     
 #
@@ -0,0 +1,80 @@
+from __future__ import division
+
+import cv2
+import numpy as np
+#
+#
+def mask_integral(mask):
+  # Integral image counting the non-zero pixels of `mask`, shape (h+1, w+1)
+  return cv2.integral((mask != 0).astype(np.uint8))
+#
+def rect_sums(integral, top, bottom, left, right):
+  # Sum of the pixels within [top:bottom, left:right], coordinates may be
+  # scalars or any broadcastable index arrays.
+  return integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+#
+def window_grid(shape, window, stride):
+  # Top/left coordinates of the sliding windows, same as
+  # range(0, h - window_h, stride_h) x range(0, w - window_w, stride_w)
+  _h, _w = shape[:2]
+  tops  = np.arange(0, _h - window[0], stride[0])
+  lefts = np.arange(0, _w - window[1], stride[1])
+  return tops, lefts
+#
+def find_candidates(mask, window_size, stride, roi_ratio, integral = None):
+  """
+  Sliding window search over a binary mask, returns the (top, bottom, left, right)
+  rectangles whose ratio of non-zero pixels is within the open range `roi_ratio`.
+  Rectangles are ordered by window size, then row-major like the nested loops.
+  """
+  if integral is None:
+    integral = mask_integral(mask)
+
+  rects = []
+  for wi, window in enumerate(window_size):
+    tops, lefts = window_grid(mask.shape, window, stride[wi])
+    if len(tops) == 0 or len(lefts) == 0: continue
+    counts = rect_sums(integral, tops[:, None], tops[:, None] + window[0], lefts[None, :], lefts[None, :] + window[1])
+    ratios = counts / float(window[0] * window[1])
+    rows, cols = np.nonzero((ratios > roi_ratio[0]) & (ratios < roi_ratio[1]))
+    rects.extend((int(h), int(h) + window[0], int(w), int(w) + window[1]) for h, w in zip(tops[rows], lefts[cols]))
+  return rects
+#
+def histogram_integral(img, bins):
+  # Integral histogram of an 8-bit image, one integral image per bin of every
+  # channel (binned over [0, 256) like cv2.calcHist), shape (h+1, w+1, sum(bins))
+  _h, _w = img.shape[:2]
+  integral = np.zeros((_h + 1, _w + 1, sum(bins)), np.int32)
+  offset = 0
+  for channel, nbins in enumerate(bins):
+    lut = np.arange(256) * nbins // 256
+    onehot = np.eye(nbins, dtype=np.int32)[lut[img[:, :, channel]]]
+    integral[1:, 1:, offset:offset + nbins] = onehot.cumsum(axis=0).cumsum(axis=1)
+    offset += nbins
+  return integral
+#
+def scale_rects(rects, scale):
+  # Map (top, bottom, left, right) rectangles of a pyramid level back to level 0
+  return [(top*scale, bottom*scale, left*scale, right*scale) for top, bottom, left, right in rects]
+#
+def non_max_suppression(rects, scores, max_overlap = 0.3):
+  """
+  Greedy non-maximum suppression of (top, bottom, left, right) rectangles: the best
+  scored one is kept and every other overlapping it by more than `max_overlap`
+  (intersection over union) is dropped. Returns the indices of the kept rects.
+  """
+  if len(rects) == 0:
+    return []
+
+  top, bottom, left, right = np.asarray(rects, dtype=np.float64).T
+  areas = (bottom - top) * (right - left)
+  order = np.argsort(-np.asarray(scores, dtype=np.float64), kind='mergesort')
+  keep = []
+  while len(order) > 0:
+    best, rest = order[0], order[1:]
+    keep.append(int(best))
+    inter = np.maximum(0, np.minimum(bottom[best], bottom[rest]) - np.maximum(top[best], top[rest])) * \
+            np.maximum(0, np.minimum(right[best], right[rest]) - np.maximum(left[best], left[rest]))
+    order = rest[inter / (areas[best] + areas[rest] - inter) <= max_overlap]
+  return keep
+#
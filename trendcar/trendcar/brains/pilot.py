@@ -1,6 +1,7 @@
 from common.stuff  import *
 from common.pid    import PID
 from common        import imgutils
+from common.lanetracker import LaneTracker
 
 import math
 import sys
@@ -8,12 +9,15 @@ import sys
 @AutoPilot.register
 class TrendCarPilot(AutoPilot):
     _track_view_range = (0.5, 0.8)
+    _lane_tracking    = False   # steer by the bird's-eye lane model tracked across frames
+    _lane_lookahead   = 0.3     # normalized bird's-eye row the lane model is followed at
     yellow_light_range = [(20, 100, 100),(40, 255, 255)]
     green_light_range = [(40, 50, 100),(80, 255, 255)]
 
 
     def __init__(self):
-        self._inverse = 0
+        self._inverse      = 0
+        self._lane_tracker = LaneTracker()
 
 
     @AutoPilot.priority_normal
@@ -35,38 +39,23 @@ class TrendCarPilot(AutoPilot):
 
 
     def _find_max_len(self, h_list):
+        return self._find_max_len_by_row(np.atleast_2d(h_list))[0]
+
+
+    def _find_max_len_by_row(self, h_lines):
+        # Runs of 0 longer than 20 pixels on every line, excluding the side pixels,
+        # as the run lengths and the index of their last pixel for each line
         check_value     = 0
         side_region     = 1
-        max_arrow_count = -1
-        max_arrow_len   = []
-        max_arrow_idx   = []
-        arrow_len       = 0
-        update_flag     = False
-        '''
-        if np.array_equal(h_list[0: side_region], side_region*[255]) == True and np.array_equal(h_list[-side_region:], side_region*[255]) == True:
-            pass
-        else:
-            return max_arrow_len, max_arrow_idx
-        '''
-        check_list      = h_list[side_region:-side_region]
-        for i in range(len(check_list)):
-            if check_list[i]==check_value:
-                arrow_len += 1
-                if arrow_len > 20:
-                    if update_flag == False:
-                        max_arrow_count += 1
-                        update_flag = True
-                    if len(max_arrow_len) == max_arrow_count:
-                        max_arrow_len.append(arrow_len)
-                        max_arrow_idx.append(i)
-                    else:
-                        max_arrow_len[max_arrow_count] = arrow_len
-                        max_arrow_idx[max_arrow_count] = i
-            else:
-                update_flag = False
-                arrow_len = 0
-
-        return max_arrow_len, max_arrow_idx
+        min_arrow_len   = 20
+
+        row, start, length = imgutils.find_runs(h_lines[:, side_region:-side_region], check_value)
+        arrows          = length > min_arrow_len
+        row, start, length = row[arrows], start[arrows], length[arrows]
+        end             = start + length - 1
+
+        bounds          = np.searchsorted(row, np.arange(1, h_lines.shape[0]))
+        return [(l.tolist(), e.tolist()) for l, e in zip(np.split(length, bounds), np.split(end, bounds))]
 
 
     def _detect_inverse(self, dashboard):
@@ -74,51 +63,59 @@ class TrendCarPilot(AutoPilot):
         frame                 = dashboard["frame"]
         img_height            = frame.shape[0]
 
-        h_line                = self._flatten_rgb(frame[img_height-25:img_height,:,:])
-        h_line_0              = h_line[0,:,2]
-        h_line_1              = h_line[20,:,2]
-        h_line_2              = h_line[22,:,2]
-        l_line_0, i_line_0    = self._find_max_len(h_line_0)
-        l_line_1, i_line_1    = self._find_max_len(h_line_1)
-        l_line_2, i_line_2    = self._find_max_len(h_line_2)
-
-        if len(l_line_0) == 2 and l_line_0[0] > 50 and l_line_0[1] > 50:
-            if len(l_line_1) == 1 and len(l_line_2) == 1:
-                if i_line_1[0] > i_line_0[0] and i_line_1[0] < i_line_0[1]:
-                    sys.stderr.write("###  candidate\n")
-                    sys.stderr.write('0: ' + str(l_line_0) + "\n")
-                    sys.stderr.write('1: ' + str(l_line_1) + "\n")
-                    sys.stderr.write('2: ' + str(l_line_2) + "\n")
-
-
-            if len(l_line_1) == 1 and l_line_1[0] > 65 and l_line_1[0]<180:
-                if len(l_line_2) == 1 and l_line_2[0] > 55 and l_line_2[0]<180:
-                    if (l_line_1[0] - l_line_2[0]) > 8:
-                        if i_line_1[0] > i_line_0[0] and i_line_1[0] < i_line_0[1]:
-                            self._inverse = inv_count
-                            sys.stderr.write("###inversei\n")
-                            sys.stderr.write(str(l_line_0) + "\n")
-                            sys.stderr.write(str(l_line_1) + "\n")
-                            sys.stderr.write(str(l_line_2) + "\n")
-                            self._inverse = inv_count
-                            return True
+        # all the bottom 25 rows are flattened and scanned at once: the inverse marking leaves two wide
+        # gaps on the upper rows of the strip and a single gap narrowing downwards on the lower rows,
+        # which has to lie between the two upper gaps
+        h_line                = self._flatten_rgb(frame[img_height - 25:img_height, :, :])
+        h_line_runs           = self._find_max_len_by_row(h_line[:,:,2])
+
+        split_rows            = [i_line for l_line, i_line in h_line_runs[:5] if len(l_line) == 2 and min(l_line) > 50]
+        gap_rows              = [(row, l_line[0], i_line[0]) for row, (l_line, i_line) in enumerate(h_line_runs)
+                                 if row >= 15 and len(l_line) == 1 and 55 < l_line[0] < 180]
+
+        if len(split_rows) == 0 or len(gap_rows) < 3:
+            return False
+
+        rows, l_gaps, i_gaps  = np.array(gap_rows).T
+        narrowing             = np.polyfit(rows, l_gaps, 1)[0]   # gap length change per row
+        i_split               = split_rows[0]
+
+        if narrowing < -4.0 and np.all((i_gaps > i_split[0]) & (i_gaps < i_split[1])):
+            sys.stderr.write("###inversei\n")
+            sys.stderr.write(str(split_rows[0]) + "\n")
+            sys.stderr.write(str(l_gaps.tolist()) + "\n")
+            self._inverse = inv_count
+            return True
 
         return False
 
     import cv2
 
     def _light_check(self,dashboard,color_range):
-        img = dashboard["frame"][0:100, 0:320]
-        hava_light = False
-        img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        mask = cv2.inRange(img_hsv,color_range[0],color_range[1] )
-        _, contours, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        for cnt in contours:
-            area = cv2.contourArea(cnt)
-            if area > 50:
-                #x, y, w, h = cv2.boundingRect(cnt)
-                hava_light = True
-        return hava_light
+        return self._check_lights(dashboard, {"light": color_range})["light"]
+
+
+    def _check_lights(self, dashboard, light_ranges = None, min_area = 50):
+        # Whether a contour enclosing more than min_area pixels of each light color is seen on the
+        # top 100 rows, with the HSV conversion done on those rows only and all colors thresholded at once
+        if light_ranges is None:
+            light_ranges = {"yellow": self.yellow_light_range, "green": self.green_light_range}
+
+        names     = list(light_ranges.keys())
+        img_hsv   = cv2.cvtColor(dashboard["frame"][0:100, 0:320], cv2.COLOR_BGR2HSV)
+        bits      = imgutils.in_ranges(img_hsv, [light_ranges[name] for name in names])
+        lights    = {}
+
+        for i, name in enumerate(names):
+            mask  = cv2.compare(cv2.bitwise_and(bits, 1 << i), 0, cv2.CMP_GT)
+            if cv2.countNonZero(mask) == 0:
+                lights[name] = False
+                continue
+
+            contours = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2]
+            lights[name] = any(cv2.contourArea(cnt) > min_area for cnt in contours)
+
+        return lights
 
 
     def _find_steering_angle_by_color(self, dashboard):
@@ -134,10 +131,9 @@ class TrendCarPilot(AutoPilot):
         track_view        = self._flatten_rgb(frame[track_view_slice, :, :])
 
         track_view_gray   = cv2.cvtColor(track_view, cv2.COLOR_BGR2GRAY)
-        tracks            = map(lambda x: len(x[x > 20]), [track_view_gray])
-        tracks_seen       = filter(lambda y: y > 200, tracks)
+        tracks_seen       = np.count_nonzero(track_view_gray > 20) > 200
 
-        if len(list(tracks_seen)) == 0:
+        if not tracks_seen:
             show_image("frame", frame)             # display image to opencv window
             show_image("track_view", track_view)   # display image to opencv window
 
@@ -146,11 +142,20 @@ class TrendCarPilot(AutoPilot):
             dashboard["track_view_info"] = (track_view_slice.start, track_view_slice.stop, None)
             return -100.0   # special case
 
-        _y, _x  = np.where(track_view_gray == 76)
-        if len(_x) == 0:
-            return -100.0
+        lane_mask         = track_view_gray == 76
+
+        if self._lane_tracking and self._lane_tracker.update(lane_mask):
+            px = self._lane_tracker.get_view_point(self._lane_lookahead)[0]
+            dashboard["lane_model"    ] = self._lane_tracker.get_coefficients()
+            dashboard["lane_curvature"] = self._lane_tracker.get_curvature()
+        else:
+            px, row_px, row_counts = imgutils.mask_centroids(lane_mask)
+            if row_counts.sum() == 0:
+                return -100.0
+
+            dashboard["lane_centroids"] = row_px
+            dashboard["lane_curvature"] = self._estimate_lane_curvature(row_px, row_counts)
 
-        px = np.mean(_x)
         if np.isnan(px):
             show_image("frame", frame)             # display image to opencv window
             show_image("track_view", track_view)   # display image to opencv window
@@ -177,6 +182,17 @@ class TrendCarPilot(AutoPilot):
         return (np.pi/2 - steering_angle) * 180.0 / np.pi
 
 
+    def _estimate_lane_curvature(self, row_px, row_counts, min_rows = 5):
+        # Second derivative of the lane centroid over the track view rows (pixels per row^2)
+        # from a quadratic fit weighted by the lane width of each row, None if too few rows are seen
+        rows = np.nonzero(row_counts)[0]
+        if len(rows) < min_rows:
+            return None
+
+        a, b, c = np.polyfit(rows, row_px[rows], 2, w = np.sqrt(row_counts[rows]))
+        return 2.0 * a
+
+
     def _flatten_rgb(self, img):
         b, g, r = cv2.split(img)
         b_filter = (b == np.maximum(np.maximum(r, g), b)) & (b >= 120) & (r < 150) & (g < 150)
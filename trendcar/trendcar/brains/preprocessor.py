@@ -71,6 +71,7 @@ class Preprocessor(AutoPilot):
                     return None
 
                 detected, rect, nr_rect = self.detect_go(dashboard["frame"])
+                dashboard["go_motion_score"] = Preprocessor._detect_go_motion_score
 
                 if rect is not None:
                     dashboard["focused_rect"   ] = rect
@@ -101,6 +102,7 @@ class Preprocessor(AutoPilot):
     _detect_go_frame        = None
     _detect_go_result       = (None, None, -1)
     _detect_go_proc         = None
+    _detect_go_motion_score = None
 
 
     @staticmethod
@@ -108,6 +110,7 @@ class Preprocessor(AutoPilot):
         if frame is None:
             Preprocessor._detect_go_frame  = None
             Preprocessor._detect_go_result = (None, None, -1)
+            Preprocessor._detect_go_motion_score = None
             Preprocessor.close_detect_go()
             return (None, None, -1)
 
@@ -188,7 +191,8 @@ class Preprocessor(AutoPilot):
             elapsed1 = monotonic() - start
 
             if result is not None:
-                detected, rect_union, rect_count, elapsed2 = result
+                detected, rect_union, rect_count, elapsed2, motion_score = result
+                Preprocessor._detect_go_motion_score = motion_score
                 debug("Preprocessor: detect_go returned %d candidates within the rectangle area %s in %0.4f seconds (actual processing time: %0.4f seconds, IO latency: %0.4f seconds)", rect_count, rect_union, elapsed1, elapsed2, elapsed1 - elapsed2)
                 return detected, rect_union, rect_count
 
@@ -273,7 +277,7 @@ class Preprocessor(AutoPilot):
                 else:
                     rect_union = None
 
-                result = pickle.dumps((detected, rect_union, rect_count, elapsed))
+                result = pickle.dumps((detected, rect_union, rect_count, elapsed, _detect_go.motion_gate.score))
 
                 fout.write(struct.pack('<I', len(result)))
                 fout.write(result)
@@ -1,5 +1,6 @@
 from common.stuff     import *
 from car              import model
+from common           import metrics
 
 from collections      import OrderedDict
 import threading
@@ -324,6 +325,9 @@ class Control(object):
                 "ready_to_go"      : self.ready_to_go(),
             }
 
+            stage_time = monotonic()
+            metrics.observe("dashboard_stage", stage_time - last_output_time, stage = "capture")
+
             for editor, context in self._dashboard_editor_list:
                 try:
                     if context is None:
@@ -334,6 +338,10 @@ class Control(object):
                             break
                 except:
                     error_exc("Error executing dashboard editor %s", repr(editor))
+                finally:
+                    end_time   = monotonic()
+                    metrics.observe("dashboard_editor", end_time - stage_time, name = metrics.callable_name(editor))
+                    stage_time = end_time
 
             for observer, context in self._dashboard_observer_list:
                 try:
@@ -345,8 +353,13 @@ class Control(object):
                             break
                 except:
                     error_exc("Error executing dashboard observer %s", repr(observer))
+                finally:
+                    end_time   = monotonic()
+                    metrics.observe("dashboard_observer", end_time - stage_time, name = metrics.callable_name(observer))
+                    stage_time = end_time
 
             last_process_time = monotonic() - last_output_time
+            metrics.observe("dashboard_stage", last_process_time, stage = "total")
 
             frame_count   += 1
             frame_end_time = monotonic()
@@ -385,6 +398,8 @@ class Control(object):
                     if request is None:
                         continue
 
+                    metrics.observe("dispatcher_queue_age", monotonic() - request[self.REQUEST_UPDATED], command = request[self.REQUEST_COMMAND])
+
                     if request[self.REQUEST_COMMAND] == self.REQUEST_COMMAND_DRIVE:
                         try:
                             self._dispatcher_mutex.release()
@@ -1,7 +1,8 @@
 from common.stuff import *
 
+import binascii
 import numpy as np
-from common import imgutils
+from common import metrics
 from collections import OrderedDict
 
 _models = OrderedDict()
@@ -599,6 +600,8 @@ class TrendCarModel(Model):
                 except:
                     warn_exc("TrendCarModel: Unable to retrieve the image frame from camera[%d]", ndx)
 
+                metrics.increment("camera_drops", camera = ndx)
+
                 if ndx in self._cam_cache and now - self._cam_cache[ndx]["timestamp"] < camera_cache_max_life:
                     snapshots.append(self._cam_cache[ndx]["frame"])
                 else:
@@ -625,6 +628,8 @@ class TrendCarModel(Model):
             except:
                 warn_exc("TrendCarModel: Unable to retrieve the image frame from camera[%d]", ndx)
 
+            metrics.increment("camera_drops", camera = ndx)
+
             if ndx in self._cam_cache and now - self._cam_cache[ndx]["timestamp"] < camera_cache_max_life:
                 return self._cam_cache[ndx]["frame"]
         else:
@@ -643,13 +648,14 @@ class TrendCarSimulatorModel(Model):
         super(type(self), self).__init__()
         self._mutex                 = threading.Lock()
         self._raw_image             = None
+        self._raw_image_event       = threading.Condition(threading.Lock())
         self._frame                 = None
+        self._decoder_thread        = None
         self._first_connected       = False
 
         self._is_running            = False
         self._websocket             = None
-        self._websocket_recv_thread = None
-        self._websocket_send_thread = None
+        self._websocket_thread      = None
         self._simulators            = []
 
 
@@ -665,6 +671,8 @@ class TrendCarSimulatorModel(Model):
                     super(type(self), self).__init__(server, sock, address, user_context)
                     self._input_seq  = -1
                     self._output_seq = -1
+                    self._steer      = None   # latest steer held until the next telemetry
+                    self._steer_lock = threading.Lock()
 
 
                 def _get_json_data(self, msg):
@@ -692,22 +700,68 @@ class TrendCarSimulatorModel(Model):
 
 
                 def _drive(self, steering, throttle):
-                    while self._input_seq >= 0 and self._output_seq >= self._input_seq + 1:
-                        time.sleep(0.0025)
+                    # Lockstep with the simulator: one steer per telemetry, sent at once if the
+                    # last telemetry was not answered yet, otherwise held (replacing any held
+                    # one) and sent by _on_telemetry(), without blocking the caller
+                    with self._steer_lock:
+                        if self._output_seq < 0 or self._input_seq < 0:
+                            return
 
-                    if self._output_seq < 0 or self._input_seq < 0:
-                        return
+                        self._steer = (steering, throttle)
+                        self._send_steer()
 
-                    self.sendMessage(r"""42["steer",{"steering_angle":"%f","throttle":"%f"}]""" % (steering, throttle), True)
-                    self._output_seq += 1
 
+                def _send_steer(self):
+                    if self._steer is not None and self._output_seq < self._input_seq + 1:
+                        self.sendMessage(r"""42["steer",{"steering_angle":"%f","throttle":"%f"}]""" % self._steer, True)
+                        self._steer       = None
+                        self._output_seq += 1
 
-                def handleMessage(self):
-                    msg = self.data.decode("iso8859-1")
 
-                    if not msg or len(msg) == 0:
+                def _on_telemetry(self, raw_image):
+                    self.getUserContext()._post_raw_image(raw_image)
+
+                    with self._steer_lock:
+                        self._input_seq += 1
+                        self._send_steer()
+
+
+                def _get_image_field(self, data):
+                    # Base64 image string of a telemetry message, found without parsing the JSON
+                    # (a memoryview of the received frame for binary messages), None if missing
+                    binary = isinstance(data, bytearray)
+                    quote, escaped, slash, key = (b'"', b"\\/", b"/", b'"image":"') if binary else ('"', "\\/", "/", '"image":"')
+
+                    start = data.find(key)
+                    if start < 0:
+                        return None
+
+                    start += len(key)
+                    end    = data.find(quote, start)
+                    if end < 0:
+                        return None
+
+                    if data.find(escaped[:1], start, end) >= 0:
+                        return data[start: end].replace(escaped, slash)
+
+                    return memoryview(data)[start: end] if binary else data[start: end]
+
+
+                def handleMessage(self):
+                    # text frames are already decoded by WebSocket, binary ones are bytearrays
+                    data = self.data
+                    if not data or len(data) == 0:
                         return
 
+                    head = data[:16].decode("iso8859-1") if isinstance(data, bytearray) else data[:16]
+                    if head.startswith('42["telemetry"'):
+                        image = self._get_image_field(data)
+                        if image is not None:
+                            self._on_telemetry(image)
+                            return
+
+                    msg = data.decode("iso8859-1") if isinstance(data, bytearray) else data
+
                     # protocol description: https://github.com/socketio/engine.io-protocol
 
                     #if msg[0] == "1": #close transport
@@ -730,10 +784,7 @@ class TrendCarSimulatorModel(Model):
 
                         try:
                             if res[0] == "telemetry":
-                                with self.getUserContext()._mutex:
-                                    self.getUserContext()._frame     = None
-                                    self.getUserContext()._raw_image = res[1]["image"]
-                                    self._input_seq += 1
+                                self._on_telemetry(res[1]["image"])
 
                         except:
                             debug_exc("TrendCarSimulatorModel: json data error")
@@ -767,8 +818,11 @@ class TrendCarSimulatorModel(Model):
                 def handleClose(self):
                     try:
                         self.getUserContext()._simulators.remove(self)
-                        self._input_seq  = -1
-                        self._output_seq = -1
+
+                        with self._steer_lock:
+                            self._input_seq  = -1
+                            self._output_seq = -1
+                            self._steer      = None
 
                         debug("TrendCarSimulatorModel: simulator closed")
                     except:
@@ -781,38 +835,25 @@ class TrendCarSimulatorModel(Model):
             if hwinfo.is_running_in_pi():
                 allow_incoming_ipv4_tcp(4567)
 
-            def websocket_receiving_loop():
-                set_thread_name("websocket-recv")
-                debug("TrendCarSimulatorModel: websocket_receiving_loop started")
+            def websocket_loop():
+                set_thread_name("websocket")
+                debug("TrendCarSimulatorModel: websocket_loop started")
 
                 try:
                     while self._is_running:
-                        self._websocket.serve_receiving_once()
+                        self._websocket.serve_events_once(1.0)
                 except:
-                    debug_exc("TrendCarSimulatorModel: exception occurred at websocket_receiving_loop")
+                    debug_exc("TrendCarSimulatorModel: exception occurred at websocket_loop")
 
                 self._is_running = False
-                debug("TrendCarSimulatorModel: websocket_receiving_loop exited")
-
-            def websocket_sending_loop():
-                set_thread_name("websocket-send")
-                debug("TrendCarSimulatorModel: websocket_sending_loop started")
-
-                try:
-                    while self._is_running:
-                        self._websocket.serve_sending_once()
-                except:
-                    debug_exc("TrendCarSimulatorModel: exception occurred at websocket_sending_loop")
-
-                self._is_running = False
-                debug("TrendCarSimulatorModel: websocket_sending_loop exited")
-
-            self._websocket_recv_thread = threading.Thread(target = websocket_receiving_loop)
-            self._websocket_recv_thread.setDaemon(True)
-            self._websocket_recv_thread.start()
-            self._websocket_send_thread = threading.Thread(target = websocket_sending_loop)
-            self._websocket_send_thread.setDaemon(True)
-            self._websocket_send_thread.start()
+                debug("TrendCarSimulatorModel: websocket_loop exited")
+
+            self._websocket_thread = threading.Thread(target = websocket_loop)
+            self._websocket_thread.setDaemon(True)
+            self._websocket_thread.start()
+            self._decoder_thread = threading.Thread(target = self._decoding_loop)
+            self._decoder_thread.setDaemon(True)
+            self._decoder_thread.start()
             return True
 
         except:
@@ -840,6 +881,10 @@ class TrendCarSimulatorModel(Model):
         self._is_running      = False
         self._first_connected = False
 
+        with self._raw_image_event:
+            self._raw_image = None
+            self._raw_image_event.notify_all()
+
         if self._websocket is not None:
             try:
                 self._websocket.close()
@@ -867,23 +912,57 @@ class TrendCarSimulatorModel(Model):
         if len(self._simulators) == 0:
             return False
 
-        for simulator in self._simulators:
+        for simulator in list(self._simulators):
             simulator._drive(steering, throttle)
 
         return True
 
 
+    def _post_raw_image(self, raw_image):
+        # Hands the base64 image of the latest telemetry to the decoding thread, replacing
+        # the one not decoded yet
+        with self._raw_image_event:
+            self._raw_image = raw_image
+            self._raw_image_event.notify()
+
+
+    def _decoding_loop(self):
+        set_thread_name("simulator-decode")
+        debug("TrendCarSimulatorModel: decoding_loop started")
+
+        while self._is_running:
+            with self._raw_image_event:
+                if self._raw_image is None:
+                    self._raw_image_event.wait(1.0)
+                    continue
+
+                raw_image, self._raw_image = self._raw_image, None
+
+            try:
+                frame = cv2.imdecode(np.frombuffer(binascii.a2b_base64(raw_image), np.uint8), cv2.IMREAD_COLOR)
+            except:
+                debug_exc("TrendCarSimulatorModel: exception occurred while decoding the telemetry image")
+                frame = None
+
+            if frame is None:
+                metrics.increment("camera_drops", camera = 0)
+                continue
+
+            with self._mutex:
+                self._frame = frame
+
+        with self._raw_image_event:
+            self._raw_image = None
+
+        debug("TrendCarSimulatorModel: decoding_loop exited")
+
+
     def get_snapshot(self, ndx = None):
         with self._mutex:
-            if self._raw_image is None:
+            if self._frame is None:
                 frame_width  = self.get_frame_width()
                 frame_height = self.get_frame_height()
                 self._frame  = np.zeros((frame_height, frame_width, 3), np.uint8)
-            elif self._frame is None:
-                import base64
-                from PIL import Image
-                from io  import BytesIO
-                self._frame = imgutils.rgb2bgr(np.asarray(Image.open(BytesIO(base64.b64decode(self._raw_image)))))
 
             if ndx is None:
                 return [self._frame]
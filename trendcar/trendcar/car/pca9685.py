@@ -3,6 +3,26 @@ try:
 except:
     import smbus
 
+from common import metrics
+
+
+class _MeteredSMBus(object):
+    # SMBus proxy counting the I2C transactions by kind (write_byte_data, read_i2c_block_data...)
+    def __init__(self, bus):
+        self._bus = bus
+
+
+    def __getattr__(self, name):
+        method = getattr(self._bus, name)
+        if not (name.startswith("write_") or name.startswith("read_")):
+            return method
+
+        def metered(*args):
+            metrics.increment("i2c_transactions", kind = name)
+            return method(*args)
+
+        return metered
+
 
 # PCA9685 spec: # http://wiki.sunfounder.cc/images/e/ea/PCA9685_datasheet.pdf
 class PCA9685(object):
@@ -54,7 +74,7 @@ class PCA9685(object):
         self._cacheable = cacheable
 
         self._delay()
-        self._i2c_bus   = smbus.SMBus(1)  # /dev/i2c-1
+        self._i2c_bus   = _MeteredSMBus(smbus.SMBus(1))  # /dev/i2c-1
         self.i2c_addr   = i2c_addr
         self.pwm_freq   = pwm_freq
 
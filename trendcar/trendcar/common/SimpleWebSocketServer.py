@@ -20,8 +20,12 @@ import struct
 import ssl
 import errno
 import codecs
+import select as selectmodule
+import threading
 from collections import deque
+from itertools import islice
 from select import select
+import numpy as np
 
 __all__ = ['WebSocket',
             'SimpleWebSocketServer',
@@ -63,10 +67,6 @@ PING = 0x9
 PONG = 0xA
 
 HEADERB1 = 1
-HEADERB2 = 3
-LENGTHSHORT = 4
-LENGTHLONG = 5
-MASK = 6
 PAYLOAD = 7
 
 MAXHEADER = 65536
@@ -89,9 +89,10 @@ class WebSocket(object):
       self.opcode = 0
       self.hasmask = 0
       self.maskarray = None
+      self.maskkey = None
       self.length = 0
-      self.lengtharray = None
       self.index = 0
+      self.pending = None
       self.request = None
       self.usingssl = False
 
@@ -101,6 +102,7 @@ class WebSocket(object):
       self.frag_decoder = codecs.getincrementaldecoder('utf-8')(errors='strict')
       self.closed = False
       self.sendq = deque()
+      self.writable = False
 
       self.state = HEADERB1
 
@@ -279,12 +281,7 @@ class WebSocket(object):
          if not data:
             raise Exception("remote socket closed")
 
-         if VER >= 3:
-             for d in data:
-                 self._parseMessage(d)
-         else:
-             for d in data:
-                 self._parseMessage(ord(d))
+         self._parseData(data)
 
    def close(self, status = 1000, reason = u''):
        """
@@ -415,165 +412,119 @@ class WebSocket(object):
 
         self.sendq.append((opcode, payload))
 
-
-   def _parseMessage(self, byte):
-      # read in the header
-      if self.state == HEADERB1:
-
-         self.fin = byte & 0x80
-         self.opcode = byte & 0x0F
-         self.state = HEADERB2
-
-         self.index = 0
-         self.length = 0
-         self.lengtharray = bytearray()
-         self.data = bytearray()
-
-         rsv = byte & 0x70
-         if rsv != 0:
-            raise Exception('RSV bit must be 0')
-
-      elif self.state == HEADERB2:
-         mask = byte & 0x80
-         length = byte & 0x7F
-
-         if self.opcode == PING and length > 125:
-             raise Exception('ping packet is too large')
-
-         if mask == 128:
-            self.hasmask = True
-         else:
-            self.hasmask = False
-
-         if length <= 125:
-            self.length = length
-
-            # if we have a mask we must read it
-            if self.hasmask is True:
-               self.maskarray = bytearray()
-               self.state = MASK
-            else:
-               # if there is no mask and no payload we are done
-               if self.length <= 0:
-                  try:
-                     self._handlePacket()
-                  finally:
-                     self.state = HEADERB1
-                     self.data = bytearray()
-
-               # we have no mask and some payload
-               else:
-                  #self.index = 0
-                  self.data = bytearray()
-                  self.state = PAYLOAD
-
-         elif length == 126:
-            self.lengtharray = bytearray()
-            self.state = LENGTHSHORT
-
-         elif length == 127:
-            self.lengtharray = bytearray()
-            self.state = LENGTHLONG
+        if self.server is not None:
+           self.server._wakeup()
 
 
-      elif self.state == LENGTHSHORT:
-         self.lengtharray.append(byte)
+   def _parseData(self, data):
+      # parse a received chunk at once: frame headers are decoded with struct as soon
+      # as they are complete and payloads are unmasked in bulk into the frame buffer
+      if VER < 3:
+         data = bytearray(data)
 
-         if len(self.lengtharray) > 2:
-            raise Exception('short length exceeded allowable size')
+      if self.pending:
+         data = self.pending + data
+         self.pending = None
 
-         if len(self.lengtharray) == 2:
-            self.length = struct.unpack_from('!H', self.lengtharray)[0]
-
-            if self.hasmask is True:
-               self.maskarray = bytearray()
-               self.state = MASK
-            else:
-               # if there is no mask and no payload we are done
-               if self.length <= 0:
-                  try:
-                     self._handlePacket()
-                  finally:
-                     self.state = HEADERB1
-                     self.data = bytearray()
-
-               # we have no mask and some payload
-               else:
-                  #self.index = 0
-                  self.data = bytearray()
-                  self.state = PAYLOAD
+      view = memoryview(data) if VER >= 3 else data
+      pos = 0
+      size = len(data)
 
-      elif self.state == LENGTHLONG:
+      while pos < size:
+         if self.state == HEADERB1:
+            header = self._parseHeader(view, pos, size)
+            if header is None:
+               # incomplete header, keep it until the next chunk
+               self.pending = bytearray(view[pos:])
+               break
 
-         self.lengtharray.append(byte)
+            pos += header
 
-         if len(self.lengtharray) > 8:
-            raise Exception('long length exceeded allowable size')
-
-         if len(self.lengtharray) == 8:
-            self.length = struct.unpack_from('!Q', self.lengtharray)[0]
-
-            if self.hasmask is True:
-               self.maskarray = bytearray()
-               self.state = MASK
-            else:
-               # if there is no mask and no payload we are done
-               if self.length <= 0:
-                  try:
-                     self._handlePacket()
-                  finally:
-                     self.state = HEADERB1
-                     self.data = bytearray()
-
-               # we have no mask and some payload
-               else:
-                  #self.index = 0
-                  self.data = bytearray()
-                  self.state = PAYLOAD
-
-      # MASK STATE
-      elif self.state == MASK:
-         self.maskarray.append(byte)
-
-         if len(self.maskarray) > 4:
-            raise Exception('mask exceeded allowable size')
-
-         if len(self.maskarray) == 4:
-            # if there is no mask and no payload we are done
-            if self.length <= 0:
-               try:
-                  self._handlePacket()
-               finally:
-                  self.state = HEADERB1
-                  self.data = bytearray()
+            if self.length > 0:
+               continue
 
-            # we have no mask and some payload
-            else:
-               #self.index = 0
-               self.data = bytearray()
-               self.state = PAYLOAD
-
-      # PAYLOAD STATE
-      elif self.state == PAYLOAD:
-         if self.hasmask is True:
-            self.data.append( byte ^ self.maskarray[self.index % 4] )
          else:
-            self.data.append( byte )
+            count = min(self.length - self.index, size - pos)
+            self._readPayload(view, pos, count)
+            pos += count
 
-         # if length exceeds allowable size then we except and remove the connection
-         if len(self.data) >= self.maxpayload:
-            raise Exception('payload exceeded allowable size')
+            if self.index < self.length:
+               continue
 
-         # check if we have processed length bytes; if so we are done
-         if (self.index+1) == self.length:
-            try:
-               self._handlePacket()
-            finally:
-               #self.index = 0
-               self.state = HEADERB1
-               self.data = bytearray()
-         else:
-            self.index += 1
+         # we have processed length bytes so we are done
+         try:
+            self._handlePacket()
+         finally:
+            self.state = HEADERB1
+            self.data = bytearray()
+
+   def _parseHeader(self, data, pos, size):
+      # returns the size of the frame header at pos, None if it is not complete yet
+      if size - pos < 2:
+         return None
+
+      b1, b2 = struct.unpack_from('!BB', data, pos)
+
+      if b1 & 0x70 != 0:
+         raise Exception('RSV bit must be 0')
+
+      fin = b1 & 0x80
+      opcode = b1 & 0x0F
+      hasmask = (b2 & 0x80) == 0x80
+      length = b2 & 0x7F
+
+      if opcode == PING and length > 125:
+         raise Exception('ping packet is too large')
+
+      header = 2
+      if length == 126:
+         header += 2
+      elif length == 127:
+         header += 8
+      if hasmask:
+         header += 4
+
+      if size - pos < header:
+         return None
+
+      if length == 126:
+         length = struct.unpack_from('!H', data, pos + 2)[0]
+      elif length == 127:
+         length = struct.unpack_from('!Q', data, pos + 2)[0]
+
+      # if length exceeds allowable size then we except and remove the connection
+      if length >= self.maxpayload:
+         raise Exception('payload exceeded allowable size')
+
+      self.fin = fin
+      self.opcode = opcode
+      self.hasmask = hasmask
+      self.length = length
+      self.index = 0
+      self.data = bytearray(length)
+      self.state = PAYLOAD
+
+      if hasmask:
+         self.maskarray = bytearray(data[pos + header - 4: pos + header])
+         # the mask repeated over up to a receive buffer, sliced at the phase of each chunk
+         self.maskkey = np.tile(np.frombuffer(self.maskarray, np.uint8), (min(length, 65536) + 7) // 4)
+
+      return header
+
+   def _readPayload(self, data, pos, count):
+      src = np.frombuffer(data, np.uint8, count, pos)
+      dest = np.frombuffer(self.data, np.uint8, count, self.index)
+
+      if self.hasmask:
+         step = len(self.maskkey) - 3
+         for start in range(0, count, step):
+            end = min(start + step, count)
+            phase = (self.index + start) % 4
+            np.bitwise_xor(src[start:end], self.maskkey[phase:phase + end - start], out = dest[start:end])
+      else:
+         dest[:] = src
+
+      self.index += count
 
 
 class SimpleWebSocketServer(object):
@@ -588,6 +539,17 @@ class SimpleWebSocketServer(object):
       self.connections = {}
       self.listeners = [self.serversocket]
 
+      # event loop state, see serve_events_once()
+      self.epoll = None
+      self.loopthread = None
+      self.waker = None
+      self.wakeupPending = False
+      self.wakeupLock = threading.Lock()
+      # held while the event loop polls and dispatches, close() takes it to tear
+      # the loop down only once no poll() is running on another thread
+      self.loopLock = threading.RLock()
+      self.closing = False
+
    def _decorateSocket(self, sock):
       return sock
 
@@ -596,11 +558,21 @@ class SimpleWebSocketServer(object):
 
    def close(self):
       self.is_running = False
-      self.serversocket.close()
+      self.closing = True
+      self._wakeup()
+
+      with self.loopLock:
+         self.serversocket.close()
 
-      for desc, conn in self.connections.items():
-         conn.close()
-         self._handleClose(conn)
+         connections, self.connections = self.connections, {}
+         for desc, conn in connections.items():
+            conn.close()
+            self._handleClose(conn)
+
+         if self.epoll is not None and not self.epoll.closed:
+            self.epoll.close()
+            for sock in self.waker:
+               sock.close()
 
    def _handleClose(self, client):
       client.client.close()
@@ -753,6 +725,173 @@ class SimpleWebSocketServer(object):
             del self.connections[failed]
             self.listeners.remove(failed)
 
+   def _wakeup(self):
+      # interrupt epoll.poll() of the event loop when data is queued by another thread
+      if self.epoll is None or threading.current_thread() is self.loopthread:
+         return
+
+      with self.wakeupLock:
+         if self.wakeupPending:
+            return
+
+         self.wakeupPending = True
+         try:
+            self.waker[1].send(b'\0')
+         except socket.error:
+            pass
+
+   def _initEventLoop(self):
+      self.waker = socket.socketpair()
+      for sock in self.waker:
+         sock.setblocking(0)
+      self.epoll = selectmodule.epoll()
+
+      self.epoll.register(self.serversocket.fileno(), selectmodule.EPOLLIN)
+      self.epoll.register(self.waker[0].fileno(), selectmodule.EPOLLIN)
+
+      for fileno in self.connections:
+         self.epoll.register(fileno, selectmodule.EPOLLIN | selectmodule.EPOLLOUT | selectmodule.EPOLLET)
+
+   def _removeClient(self, fileno):
+      client = self.connections.pop(fileno, None)
+      if client is None:
+         return
+
+      try:
+         self.epoll.unregister(fileno)
+      except (IOError, OSError, ValueError):
+         pass
+
+      if fileno in self.listeners:
+         self.listeners.remove(fileno)
+
+      self._handleClose(client)
+
+   def _acceptClient(self):
+      sock = None
+      try:
+         sock, address = self.serversocket.accept()
+         newsock = self._decorateSocket(sock)
+         newsock.setblocking(0)
+         fileno = newsock.fileno()
+         self.connections[fileno] = self._constructWebSocket(newsock, address)
+         self.listeners.append(fileno)
+         # edge-triggered, EPOLLOUT is only reported when the socket becomes writable
+         self.epoll.register(fileno, selectmodule.EPOLLIN | selectmodule.EPOLLOUT | selectmodule.EPOLLET)
+      except Exception as n:
+         if sock is not None:
+            sock.close()
+
+   def _receiveAll(self, client):
+      # edge-triggered, so read until the socket would block
+      while True:
+         try:
+            client._handleData()
+         except ssl.SSLWantReadError:
+            return
+         except socket.error as e:
+            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+               return
+            raise e
+
+   def _flushClient(self, client):
+      # send the queued frames with as few sendmsg() calls as possible, until the queue
+      # is empty or the socket would block (then wait for the next EPOLLOUT)
+      scatter = not client.usingssl and hasattr(client.client, 'sendmsg')
+
+      while client.sendq:
+         try:
+            if scatter:
+               sent = client.client.sendmsg([payload for opcode, payload in islice(client.sendq, 0, 64)])
+            else:
+               sent = client.client.send(client.sendq[0][1])
+         except socket.error as e:
+            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK] or isinstance(e, ssl.SSLWantWriteError):
+               client.writable = False
+               return
+            raise e
+
+         if sent == 0:
+            raise RuntimeError('socket connection broken')
+
+         while sent > 0:
+            opcode, payload = client.sendq[0]
+            if sent < len(payload):
+               client.sendq[0] = (opcode, memoryview(payload)[sent:])
+               break
+
+            client.sendq.popleft()
+            sent -= len(payload)
+
+            if opcode == CLOSE:
+               raise Exception('received client close')
+
+   def serve_events_once(self, timeout = None):
+      """
+          Serve the connections for up to timeout seconds (forever if None) with a
+          single epoll loop: reads and accepts as events arrive, and queued frames,
+          including those queued by other threads, as soon as the sockets take them.
+          Falls back to serveonce() where epoll is not available.
+      """
+      if not hasattr(selectmodule, 'epoll'):
+         self.serveonce()
+         return
+
+      if self.closing:
+         return
+
+      with self.loopLock:
+         if self.epoll is None:
+            self._initEventLoop()
+         elif self.epoll.closed or self.closing:
+            return
+
+         self.loopthread = threading.current_thread()
+
+         try:
+            events = self.epoll.poll(-1 if timeout is None else timeout)
+         except (IOError, OSError) as e:
+            if e.errno != errno.EINTR:
+               raise e
+            events = []
+
+         for fileno, event in events:
+            if fileno == self.serversocket.fileno():
+               if event & (selectmodule.EPOLLERR | selectmodule.EPOLLHUP):
+                  self.close()
+                  raise Exception('server socket failed')
+               self._acceptClient()
+
+            elif fileno == self.waker[0].fileno():
+               # drain and clear under the lock, so that no wakeup byte of a frame
+               # queued meanwhile is swallowed while wakeupPending stays set
+               with self.wakeupLock:
+                  try:
+                     while self.waker[0].recv(4096):
+                        pass
+                  except socket.error:
+                     pass
+                  self.wakeupPending = False
+
+            elif fileno in self.connections:
+               client = self.connections[fileno]
+               try:
+                  if event & selectmodule.EPOLLOUT:
+                     client.writable = True
+                  if event & selectmodule.EPOLLIN:
+                     self._receiveAll(client)
+                  if event & (selectmodule.EPOLLERR | selectmodule.EPOLLHUP):
+                     raise Exception('remote socket failed')
+               except Exception as n:
+                  self._removeClient(fileno)
+
+         for fileno, client in list(self.connections.items()):
+            if client.sendq and client.writable:
+               try:
+                  self._flushClient(client)
+               except Exception as n:
+                  self._removeClient(fileno)
+
    def sendFragmentStart(self, data):
       for client in self.connections.values():
           client.sendFragmentStart(data)
@@ -772,7 +911,7 @@ class SimpleWebSocketServer(object):
    def serveforever(self):
       self.is_running = True
       while self.is_running:
-         self.serveonce()
+         self.serve_events_once()
 
 class SimpleSSLWebSocketServer(SimpleWebSocketServer):
 
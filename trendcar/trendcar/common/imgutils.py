@@ -62,6 +62,52 @@ def flatten_rgb(img):
     return flattened
 
 
+def find_runs(rows, value = 0):
+    # Runs of `value` in every row of a 2D array at once, returned as (row, start, length) arrays in row-major order
+    rows        = np.atleast_2d(rows)
+    matched     = np.zeros((rows.shape[0], rows.shape[1] + 2), np.int8)
+    matched[:, 1:-1] = rows == value
+    edges       = np.diff(matched, axis=1)
+    row, start  = np.nonzero(edges == 1)
+    end         = np.nonzero(edges == -1)[1]
+    return row, start, end - start
+
+
+def mask_centroids(mask):
+    # Mean column of the non-zero pixels of a mask, overall and for each row (NaN for empty rows),
+    # from per-column/row counts, with the number of pixels of each row
+    mask        = mask != 0
+    cols        = np.arange(mask.shape[1])
+    row_counts  = np.count_nonzero(mask, axis=1)
+    total       = row_counts.sum()
+    px          = np.count_nonzero(mask, axis=0).dot(cols) / float(total) if total > 0 else np.nan
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        row_px  = mask.dot(cols) / row_counts.astype(np.float64)
+
+    return px, row_px, row_counts
+
+
+_range_luts = {}
+
+def in_ranges(img, ranges):
+    # cv2.inRange() for up to 8 (lower, upper) ranges of a 3 channel image in one pass:
+    # bit i of the result is set where the pixel is within ranges[i]
+    key = tuple((tuple(lower), tuple(upper)) for lower, upper in ranges)
+
+    if key not in _range_luts:
+        assert len(key) <= 8, "at most 8 ranges are supported"
+        values  = np.arange(256)
+        lut     = np.zeros((256, 1, 3), np.uint8)
+        for i, (lower, upper) in enumerate(key):
+            for c in range(3):
+                lut[(values >= lower[c]) & (values <= upper[c]), 0, c] |= 1 << i
+        _range_luts[key] = lut
+
+    c0, c1, c2 = cv2.split(cv2.LUT(img, _range_luts[key]))
+    return cv2.bitwise_and(cv2.bitwise_and(c0, c1), c2)
+
+
 def find_lines(img):
     grayed      = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     blurred     = cv2.GaussianBlur(grayed, (3, 3), 0)
@@ -0,0 +1,162 @@
+from common.cv2compat import *
+from common           import imgutils
+
+import numpy as np
+
+
+class LaneTracker:
+    """
+    Tracks the lane of a track view as a quadratic x = a*y^2 + b*y + c in bird's-eye
+    coordinates, y being the row normalized to [0, 1] from the far (top) to the near
+    (bottom) end. The coefficients are filtered across frames with a Kalman filter
+    and, once locked, every row is measured at the center of the whole lane run
+    that starts within `band` pixels of the predicted lane.
+
+    The bird's-eye view maps the trapezoid src_quad, given as (x, y) fractions of the
+    track view, onto the whole track view. It depends on how the camera is mounted.
+    """
+    _birdeye_maps = {}   # (width, height, src_quad) -> (map_x, map_y, map1, map2, inv)
+
+
+    def __init__(self, src_quad = ((0.25, 0.0), (0.75, 0.0), (1.0, 1.0), (0.0, 1.0)), band = 20, min_rows = 5, max_misses = 5,
+                       process_noise = (4.0, 4.0, 4.0), measurement_noise = 16.0):
+        self._src_quad          = tuple(tuple(pt) for pt in src_quad)
+        self._band              = band
+        self._min_rows          = min_rows
+        self._max_misses        = max_misses
+        self._process_noise     = np.diag(np.array(process_noise, dtype=np.float64) ** 2)
+        self._measurement_noise = float(measurement_noise)
+        self.reset()
+
+
+    def reset(self):
+        self._coefficients = None
+        self._covariance   = None
+        self._misses       = 0
+        self._shape        = None
+
+
+    def _get_birdeye_maps(self, height, width):
+        # Source pixel of every bird's-eye pixel, computed once per resolution
+        key = (width, height, self._src_quad)
+
+        if key not in LaneTracker._birdeye_maps:
+            src = np.float32([(x * (width - 1), y * (height - 1)) for x, y in self._src_quad])
+            dst = np.float32([(0, 0), (width - 1, 0), (width - 1, height - 1), (0, height - 1)])
+            inv = cv2.getPerspectiveTransform(dst, src)
+
+            grid_x, grid_y = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+            z     = inv[2, 0] * grid_x + inv[2, 1] * grid_y + inv[2, 2]
+            map_x = ((inv[0, 0] * grid_x + inv[0, 1] * grid_y + inv[0, 2]) / z).astype(np.float32)
+            map_y = ((inv[1, 0] * grid_x + inv[1, 1] * grid_y + inv[1, 2]) / z).astype(np.float32)
+            map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+            LaneTracker._birdeye_maps[key] = (map_x, map_y, map1, map2, inv)
+
+        return LaneTracker._birdeye_maps[key]
+
+
+    def _get_birdeye(self, mask):
+        map_x, map_y, map1, map2, inv = self._get_birdeye_maps(*mask.shape)
+        return cv2.remap(mask.view(np.uint8), map1, map2, cv2.INTER_NEAREST)
+
+
+    def _search_full(self, mask):
+        # Per row lane centroids over the whole bird's-eye view
+        px, row_px, row_counts = imgutils.mask_centroids(self._get_birdeye(mask))
+        return row_px, row_counts
+
+
+    def _search_band(self, mask):
+        # Per row center of the lane run nearest to the predicted lane, within band pixels
+        # of its edges, weighted by the run width; measuring the whole run keeps lanes
+        # wider than the band from simply confirming the prediction
+        birdeye       = self._get_birdeye(mask)
+        height, width = birdeye.shape
+        center        = self.get_lane_x(np.arange(height) / float(height))
+
+        row, start, length = imgutils.find_runs(birdeye, 1)
+        gap           = np.maximum(np.maximum(start - center[row], center[row] - (start + length - 1)), 0)
+        near          = gap <= self._band
+        row, start, length, gap = row[near], start[near], length[near], gap[near]
+
+        # nearest run of each row: sorted by row then gap, the first of every row is kept
+        order         = np.lexsort((gap, row))
+        row, start, length = row[order], start[order], length[order]
+        first         = np.ones(len(row), bool)
+        first[1:]     = row[1:] != row[:-1]
+
+        row_px        = np.full(height, np.nan)
+        row_counts    = np.zeros(height, np.intp)
+        row_px[row[first]]     = start[first] + (length[first] - 1) / 2.0
+        row_counts[row[first]] = length[first]
+        return row_px, row_counts
+
+
+    def update(self, mask):
+        """
+        Update the lane model with a binary lane mask of the track view, returns whether
+        the lane is tracked (measured this frame or predicted within max_misses frames).
+        """
+        mask = mask != 0
+
+        if self._shape != mask.shape:
+            self.reset()
+            self._shape = mask.shape
+
+        locked = self._coefficients is not None
+        if locked:
+            self._covariance = self._covariance + self._process_noise
+            row_px, row_counts = self._search_band(mask)
+        else:
+            row_px, row_counts = self._search_full(mask)
+
+        rows = np.nonzero(row_counts)[0]
+        if len(rows) < self._min_rows:
+            self._misses += 1
+            if self._misses > self._max_misses:
+                self._coefficients, self._covariance = None, None
+            return self._coefficients is not None
+
+        # Information form of the Kalman update, every seen row measures x(y) with a
+        # variance shrinking with the number of lane pixels on it
+        y       = rows / float(mask.shape[0])
+        H       = np.stack((y * y, y, np.ones_like(y)), axis=1)
+        weights = row_counts[rows] / self._measurement_noise
+        info    = (H.T * weights).dot(H)
+        target  = (H.T * weights).dot(row_px[rows])
+
+        if locked:
+            prior_info = np.linalg.inv(self._covariance)
+            info      += prior_info
+            target    += prior_info.dot(self._coefficients)
+
+        try:
+            self._covariance   = np.linalg.inv(info)
+            self._coefficients = self._covariance.dot(target)
+            self._misses       = 0
+        except np.linalg.LinAlgError:
+            self._misses += 1
+
+        return self._coefficients is not None
+
+
+    def get_coefficients(self):
+        return None if self._coefficients is None else tuple(self._coefficients)
+
+
+    def get_lane_x(self, y):
+        # Bird's-eye lane column at the normalized row y (0: far end, 1: near end)
+        a, b, c = self._coefficients
+        return a * y * y + b * y + c
+
+
+    def get_view_point(self, y):
+        # Track view (x, y) pixel of the lane at the normalized bird's-eye row y
+        height, width = self._shape
+        inv           = self._get_birdeye_maps(height, width)[4]
+        x, y, z       = inv.dot((self.get_lane_x(y), y * height, 1.0))
+        return x / z, y / z
+
+
+    def get_curvature(self):
+        return None if self._coefficients is None else 2.0 * self._coefficients[0]
@@ -0,0 +1,170 @@
+from common.monotonic import monotonic
+
+import os
+import threading
+
+# Process wide performance metrics: counters, timing summaries and gauges, each keyed by a
+# name and optional labels, exported as a JSON friendly dict or in the Prometheus text format
+
+_mutex       = threading.Lock()
+_counters    = {}   # name -> {labels: value}
+_timings     = {}   # name -> {labels: [count, sum, max, last]}
+_gauges      = {}   # name -> {labels: value}
+_cpu_samples = {}   # thread id -> (timestamp, cpu seconds)
+_clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def increment(name, value = 1, **labels):
+    key = _labels_key(labels)
+    with _mutex:
+        values      = _counters.setdefault(name, {})
+        values[key] = values.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    key = _labels_key(labels)
+    with _mutex:
+        values = _timings.setdefault(name, {})
+        timing = values.get(key, None)
+
+        if timing is None:
+            values[key] = [1, seconds, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2]  = max(timing[2], seconds)
+            timing[3]  = seconds
+
+
+def set_gauge(name, value, **labels):
+    key = _labels_key(labels)
+    with _mutex:
+        _gauges.setdefault(name, {})[key] = value
+
+
+def callable_name(func):
+    # Readable name of a registered callback, for labels
+    name = getattr(func, "__qualname__", None) or getattr(func, "__name__", None)
+    if name is None:
+        return func.__class__.__name__
+
+    owner = getattr(func, "__self__", None)
+    if owner is not None and "." not in name:
+        name = "%s.%s" % (owner.__class__.__name__ if not isinstance(owner, type) else owner.__name__, name)
+
+    return name
+
+
+def _read_file(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def _thread_cpu_stats():
+    # CPU seconds and usage since the last sample of every thread, by the thread names
+    # given by set_thread_name() (Linux only)
+    stats = {}
+    now   = monotonic()
+
+    try:
+        tids = os.listdir("/proc/self/task")
+    except OSError:
+        return stats
+
+    for tid in tids:
+        stat = _read_file("/proc/self/task/%s/stat" % tid)
+        if stat is None:
+            continue
+
+        name, fields = stat[stat.find("(") + 1: stat.rfind(")")], stat[stat.rfind(")") + 2:].split()
+        cpu          = (int(fields[11]) + int(fields[12])) / float(_clock_ticks)
+        last         = _cpu_samples.get(tid, None)
+        usage        = (cpu - last[1]) / (now - last[0]) if last is not None and now > last[0] else None
+        _cpu_samples[tid] = (now, cpu)
+
+        name = "%s/%s" % (name, tid) if name in stats else name
+        stats[name] = {"cpu_seconds": cpu, "cpu_usage": usage}
+
+    for tid in list(_cpu_samples.keys()):
+        if tid not in tids:
+            del _cpu_samples[tid]
+
+    return stats
+
+
+def _system_stats():
+    rss    = None
+    status = _read_file("/proc/self/status")
+
+    for line in (status or "").split("\n"):
+        if line.startswith("VmRSS:"):
+            rss = int(line.split()[1]) * 1024
+
+    temperature = _read_file("/sys/class/thermal/thermal_zone0/temp")
+
+    return {
+        "memory_rss_bytes"   : rss,
+        "temperature_celsius": int(temperature) / 1000.0 if temperature else None,
+        "load_average"       : os.getloadavg()[0] if hasattr(os, "getloadavg") else None,
+        "threads"            : _thread_cpu_stats(),
+    }
+
+
+def snapshot():
+    def by_labels(values, convert):
+        return [dict(labels = dict(key), **convert(value)) for key, value in sorted(values.items())]
+
+    with _mutex:
+        result = {
+            "counters": dict((name, by_labels(values, lambda v: {"value": v})) for name, values in _counters.items()),
+            "timings" : dict((name, by_labels(values, lambda t: {"count": t[0], "sum": t[1], "max": t[2], "last": t[3], "avg": t[1] / t[0]})) for name, values in _timings.items()),
+            "gauges"  : dict((name, by_labels(values, lambda v: {"value": v})) for name, values in _gauges.items()),
+        }
+
+        result["system"] = _system_stats()
+
+    return result
+
+
+def to_prometheus(result = None, prefix = "trendcar_"):
+    def labels_text(labels):
+        if not labels:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in sorted(labels.items()))
+
+    result = result if result is not None else snapshot()
+    lines  = []
+
+    for name, values in sorted(result["counters"].items()):
+        lines.append("# TYPE %s%s_total counter" % (prefix, name))
+        lines.extend("%s%s_total%s %s" % (prefix, name, labels_text(v["labels"]), v["value"]) for v in values)
+
+    for name, values in sorted(result["timings"].items()):
+        lines.append("# TYPE %s%s_seconds summary" % (prefix, name))
+        for v in values:
+            lines.append("%s%s_seconds_count%s %d"  % (prefix, name, labels_text(v["labels"]), v["count"]))
+            lines.append("%s%s_seconds_sum%s %.6f"  % (prefix, name, labels_text(v["labels"]), v["sum"]))
+            lines.append("%s%s_seconds_max%s %.6f"  % (prefix, name, labels_text(v["labels"]), v["max"]))
+
+    for name, values in sorted(result["gauges"].items()):
+        lines.append("# TYPE %s%s gauge" % (prefix, name))
+        lines.extend("%s%s%s %s" % (prefix, name, labels_text(v["labels"]), v["value"]) for v in values if v["value"] is not None)
+
+    system = result["system"]
+    for name in ("memory_rss_bytes", "temperature_celsius", "load_average"):
+        if system[name] is not None:
+            lines.append("# TYPE %s%s gauge" % (prefix, name))
+            lines.append("%s%s %s" % (prefix, name, system[name]))
+
+    if system["threads"]:
+        lines.append("# TYPE %sthread_cpu_seconds_total counter" % prefix)
+        lines.extend("%sthread_cpu_seconds_total%s %.2f" % (prefix, labels_text({"thread": name}), stats["cpu_seconds"]) for name, stats in sorted(system["threads"].items()))
+
+    return "\n".join(lines) + "\n"
@@ -1,5 +1,6 @@
 from common.logging   import *
 from common           import config
+from common           import metrics
 from common.utils     import *
 from car.control      import Control
 
@@ -196,6 +197,7 @@ class AutoPilot(object):
                     start = monotonic()
                     command = pilot_context["pilot"].on_inquiry_drive(AutoPilot._dashboard, pilot_context.get("last_result", AutoPilot.RESULT_NA))
                     elapsed = monotonic() - start
+                    metrics.observe("pilot_inquiry", elapsed, pilot = pilot_context["pilot"].__class__.__name__)
 
                     with pilot_context["mutex"]:
                         pilot_context["command"] = command
@@ -489,6 +491,7 @@ class AutoPilot(object):
 
                                         if elapsed >= AutoPilot._response_timeout:
                                             debug("AutoPilot: %s.on_inquiry_drive() timed out", pilot_context["pilot"].__class__.__name__)
+                                            metrics.increment("pilot_timeouts", pilot = pilot_context["pilot"].__class__.__name__)
                                             continue
 
                                         if pilot_context["command"] is None:
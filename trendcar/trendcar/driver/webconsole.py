@@ -1,7 +1,10 @@
 from common.stuff import *
+from common.SimpleWebSocketServer import WebSocket, SimpleWebSocketServer
+from common import metrics
 
 import json
 import socket
+import struct
 import threading
 
 try:
@@ -10,15 +13,190 @@ except:
     import socketserver as SocketServer
 
 
+class WebConsoleServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    # Serves every client connection on its own thread, up to max_clients connections at once;
+    # connections turned into long-lived streams (MJPEG, SSE) count against max_streams instead,
+    # so open live views never lock /drive and the other requests out
+    allow_reuse_address       = True
+    daemon_threads            = True
+    block_on_close            = False
+
+    def __init__(self, server_address, handler_class, max_clients, max_streams):
+        self._max_clients     = max_clients
+        self._max_streams     = max_streams
+        self._clients         = 0
+        self._streams         = set()
+        self._clients_mutex   = threading.Lock()
+        SocketServer.TCPServer.__init__(self, server_address, handler_class)
+
+
+    def verify_request(self, request, client_address):
+        with self._clients_mutex:
+            if self._clients >= self._max_clients:
+                warn("WebConsole: too many clients, rejected %s", repr(client_address))
+                return False
+
+            self._clients += 1
+            return True
+
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self._clients_mutex:
+                if request in self._streams:
+                    self._streams.remove(request)
+                else:
+                    self._clients -= 1
+
+
+    def start_stream(self, request):
+        # Moves a connection from the client slots to the stream ones, False if they are all taken
+        with self._clients_mutex:
+            if request in self._streams:
+                return True
+
+            if len(self._streams) >= self._max_streams:
+                return False
+
+            self._streams.add(request)
+            self._clients -= 1
+            return True
+
+
+    def get_client_count(self):
+        return self._clients
+
+
+    def get_stream_count(self):
+        return len(self._streams)
+
+
+class AdaptivePreview:
+    """
+    Preview settings of one streaming client: the JPEG quality and the downscale factor are
+    lowered while the frame rate the client can take within the bandwidth budget falls below
+    min_fps or its RTT grows, and frames are skipped to pace the stream to that bandwidth.
+    """
+    _LEVELS = ((None, 1.0), (60, 1.0), (45, 0.75), (35, 0.5), (25, 0.5))  # (JPEG quality, scale), None for the configured quality
+    _HOLD_SECONDS = 2.0   # time a level is kept before it is changed again
+
+
+    def __init__(self, sock, budget, min_fps):
+        self._sock       = sock
+        self._budget     = float(budget)   # bytes per second
+        self._min_fps    = min_fps
+        self._level      = 0
+        self._changed    = None
+        self._throughput = None
+        self._rtt        = None
+        self._min_rtt    = None
+        self._next_time  = 0.0
+
+
+    def _measure_rtt(self):
+        # Smoothed RTT of the connection in seconds from TCP_INFO (Linux only)
+        try:
+            return struct.unpack_from("I", self._sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104), 68)[0] / 1000000.0
+        except:
+            return None
+
+
+    def is_due(self, now):
+        return now >= self._next_time
+
+
+    def get_level(self):
+        return self._LEVELS[self._level]
+
+
+    def get_stats(self):
+        quality, scale = self.get_level()
+        return {"quality": quality, "scale": scale, "throughput": self._throughput, "rtt": self._rtt}
+
+
+    def update(self, size, start, end):
+        # Called after sending a frame of size bytes between start and end
+        rate             = size / max(end - start, 0.0001)
+        self._throughput = rate if self._throughput is None else self._throughput * 0.8 + rate * 0.2
+        self._rtt        = self._measure_rtt()
+
+        if self._rtt is not None:
+            self._min_rtt = self._rtt if self._min_rtt is None else min(self._min_rtt, self._rtt)
+
+        bandwidth        = min(self._budget, self._throughput)
+        self._next_time  = start + size / bandwidth
+
+        if self._changed is None:
+            self._changed = start
+        if end - self._changed < self._HOLD_SECONDS:
+            return
+
+        fps              = bandwidth / size
+        congested        = self._rtt is not None and self._rtt > self._min_rtt * 2 + 0.02
+
+        if (fps < self._min_fps or congested) and self._level < len(self._LEVELS) - 1:
+            self._level  += 1
+            self._changed = end
+        elif fps > self._min_fps * 3 and not congested and self._level > 0:
+            self._level  -= 1
+            self._changed = end
+
+
+class DriveChannel(WebSocket):
+    """
+    Remote driving over a WebSocket. The client sends binary DRIVE_FRAME messages (steering in
+    degrees, throttle in -1.0 - 1.0, sequence number, client timestamp in ms), each applied frame
+    is acknowledged by a DRIVE_ACK message echoing its sequence number and client timestamp with
+    the server timestamp in ms, so the client can measure the RTT. Frames older than the last
+    applied one are dropped.
+    """
+    DRIVE_FRAME = struct.Struct("!ffId")
+    DRIVE_ACK   = struct.Struct("!IddffB")
+
+    def handleConnected(self):
+        self._last_seq = None
+
+
+    def handleMessage(self):
+        if not isinstance(self.data, bytearray) or len(self.data) != DriveChannel.DRIVE_FRAME.size:
+            return
+
+        steering, throttle, seq, client_time = DriveChannel.DRIVE_FRAME.unpack_from(self.data)
+
+        # sequence numbers wrap around at 2^32
+        if self._last_seq is not None and not 0 < ((seq - self._last_seq) & 0xffffffff) < 0x80000000:
+            return
+
+        self._last_seq = seq
+        driven = self.getUserContext()._drive(steering, throttle)
+        self.sendMessage(bytearray(DriveChannel.DRIVE_ACK.pack(seq, client_time, monotonic() * 1000.0, steering, throttle, driven)))
+
+
 class WebConsole(SocketServer.BaseRequestHandler):
     _DEF_HOST                 = "0.0.0.0"
     _DEF_PORT                 = 9999
     _DEF_JPEG_QUALITY_LEVEL   = 80  # JPEG quality level: 0 - 100
     _DEF_IMAGE_RENEW_INTERVAL = 250
     _DEF_MAX_IDLE_TAKING_OVER = 3
+    _DEF_MAX_CLIENTS          = 16
+    _DEF_MAX_STREAMS          = 16  # MJPEG and SSE streams, not counted in max_clients
+    _DEF_KEEP_ALIVE_SECONDS   = 5
+    _DEF_MAX_IMAGE_REQUESTS   = 2   # image requests encoded at once, the others wait while /drive never does
+    _DEF_PREVIEW_BANDWIDTH    = 2000  # adaptive preview bandwidth budget per client, kbps
+    _DEF_PREVIEW_MIN_FPS      = 10
+    _DEF_DRIVE_PORT           = 9998  # WebSocket drive channel, 0 to disable
+    _MAX_REQUEST_SIZE         = 8192
     _jpeg_quality_level       = _DEF_JPEG_QUALITY_LEVEL
     _image_renew_interval     = _DEF_IMAGE_RENEW_INTERVAL
     _max_idle_taking_over     = _DEF_MAX_IDLE_TAKING_OVER
+    _max_clients              = _DEF_MAX_CLIENTS
+    _max_streams              = _DEF_MAX_STREAMS
+    _keep_alive_seconds       = _DEF_KEEP_ALIVE_SECONDS
+    _image_slots              = threading.BoundedSemaphore(_DEF_MAX_IMAGE_REQUESTS)
+    _preview_bandwidth        = _DEF_PREVIEW_BANDWIDTH
+    _preview_min_fps          = _DEF_PREVIEW_MIN_FPS
 
     STATE_INIT                = 0
     STATE_STARTING            = 1
@@ -37,10 +215,18 @@ class WebConsole(SocketServer.BaseRequestHandler):
     _snapshot_folder          = os.path.join(_basedir, "log", "snapshots")
     _recording_folder         = os.path.join(_basedir, "log", "recordings")
     _dashboard                = {}
+    _dashboard_seq            = 0
+    _dashboard_updated        = threading.Condition(threading.Lock())
+    _stream_views             = ("frame", "track_view")
+    _jpeg_mutex               = threading.Lock()
+    _jpeg_cache               = {}  # (dashboard timestamp, view, quality) -> jpeg of the latest dashboard only
+    _jpeg_cache_timestamp     = None
     _last_frame               = None
     _drive_info               = {"steering": 0.0, "throttle": 0.0}
 
     _http_server              = None
+    _drive_server             = None
+    _drive_thread             = None
     _cached_files             = {}
     _static_files             = {"/": "webconsole.html", "/joy.js": "joy.js"}
 
@@ -85,6 +271,11 @@ class WebConsole(SocketServer.BaseRequestHandler):
         return config.getint("WEBCONSOLE", "listen_port", WebConsole._DEF_PORT)
 
 
+    @staticmethod
+    def get_drive_port():
+        return config.getint("WEBCONSOLE", "drive_websocket_port", WebConsole._DEF_DRIVE_PORT)
+
+
     @staticmethod
     def start(control = None):
         with WebConsole._mutex:
@@ -165,6 +356,12 @@ class WebConsole(SocketServer.BaseRequestHandler):
         WebConsole._jpeg_quality_level   = config.getint("WEBCONSOLE", "jpeg_quality_level"          , WebConsole._DEF_JPEG_QUALITY_LEVEL)
         WebConsole._image_renew_interval = config.getint("WEBCONSOLE", "image_renewing_interval_ms"  , WebConsole._DEF_IMAGE_RENEW_INTERVAL)
         WebConsole._max_idle_taking_over = config.getint("WEBCONSOLE", "max_idle_seconds_taking_over", WebConsole._DEF_MAX_IDLE_TAKING_OVER)
+        WebConsole._max_clients          = config.getint("WEBCONSOLE", "max_clients"                 , WebConsole._DEF_MAX_CLIENTS)
+        WebConsole._max_streams          = config.getint("WEBCONSOLE", "max_streams"                 , WebConsole._DEF_MAX_STREAMS)
+        WebConsole._keep_alive_seconds   = config.getint("WEBCONSOLE", "keep_alive_seconds"          , WebConsole._DEF_KEEP_ALIVE_SECONDS)
+        WebConsole._image_slots          = threading.BoundedSemaphore(config.getint("WEBCONSOLE", "max_concurrent_image_requests", WebConsole._DEF_MAX_IMAGE_REQUESTS))
+        WebConsole._preview_bandwidth    = config.getint("WEBCONSOLE", "preview_bandwidth_kbps"      , WebConsole._DEF_PREVIEW_BANDWIDTH)
+        WebConsole._preview_min_fps      = config.getint("WEBCONSOLE", "preview_min_fps"             , WebConsole._DEF_PREVIEW_MIN_FPS)
         WebConsole._snapshot_folder      = config.get   ("DEFAULT"   , "snapshot_folder"             , os.path.join(WebConsole._basedir, "log", "snapshots"))
         WebConsole._recording_folder     = config.get   ("DEFAULT"   , "recording_folder"            , os.path.join(WebConsole._basedir, "log", "recordings"))
 
@@ -179,8 +376,7 @@ class WebConsole(SocketServer.BaseRequestHandler):
         try:
             with WebConsole._mutex:
                 try:
-                    SocketServer.TCPServer.allow_reuse_address = True
-                    WebConsole._http_server = SocketServer.TCPServer((WebConsole.get_host(), WebConsole.get_port()), WebConsole)
+                    WebConsole._http_server = WebConsoleServer((WebConsole.get_host(), WebConsole.get_port()), WebConsole, WebConsole._max_clients, WebConsole._max_streams)
                     WebConsole._http_server.timeout = 1
 
                     WebConsole._state = WebConsole.STATE_STARTED
@@ -194,6 +390,8 @@ class WebConsole(SocketServer.BaseRequestHandler):
 
             if WebConsole._http_server:
                 info("WebConsole: started, listening on %s:%d", WebConsole.get_host(), WebConsole.get_port())
+                WebConsole._start_drive_channel()
+
                 while WebConsole._state == WebConsole.STATE_STARTED:
                     try:
                         WebConsole._http_server.handle_request()
@@ -204,6 +402,8 @@ class WebConsole(SocketServer.BaseRequestHandler):
                         warn_exc("WebConsole: Exception occurred at handle_request")
 
         finally:
+            WebConsole._stop_drive_channel()
+
             if WebConsole._http_server:
                 try:
                     WebConsole._http_server.server_close()
@@ -222,6 +422,62 @@ class WebConsole(SocketServer.BaseRequestHandler):
                 os.system("sudo iptables -A IN_TRENDCAR -j RETURN")
 
 
+    @staticmethod
+    def _start_drive_channel():
+        if WebConsole.get_drive_port() <= 0:
+            return False
+
+        try:
+            server = SimpleWebSocketServer(WebConsole.get_host(), WebConsole.get_drive_port(), DriveChannel, WebConsole, selectInterval = 0.1)
+        except:
+            error_exc("WebConsole: Failed to start drive channel")
+            return False
+
+        def serve_drive_channel():
+            set_thread_name("WebConsole.drive")
+            try:
+                while WebConsole._drive_server is server:
+                    server.serve_events_once(0.1)
+            except:
+                warn_exc("WebConsole: Exception occurred at drive channel")
+
+        if hwinfo.is_running_in_pi():
+            allow_incoming_ipv4_tcp(WebConsole.get_drive_port())
+
+        WebConsole._drive_server = server
+        WebConsole._drive_thread = threading.Thread(target = serve_drive_channel, name = "WebConsole.drive")
+        WebConsole._drive_thread.daemon = True
+        WebConsole._drive_thread.start()
+        info("WebConsole: drive channel listening on %s:%d", WebConsole.get_host(), WebConsole.get_drive_port())
+        return True
+
+
+    @staticmethod
+    def _stop_drive_channel():
+        server, WebConsole._drive_server = WebConsole._drive_server, None
+
+        if WebConsole._drive_thread is not None:
+            WebConsole._drive_thread.join()
+            WebConsole._drive_thread = None
+
+        if server is not None:
+            try:
+                server.close()
+            except:
+                warn_exc("WebConsole: Exception occurred while closing drive channel")
+
+
+    @staticmethod
+    def _drive(steering, throttle):
+        WebConsole._drive_info = {"steering": steering, "throttle": throttle}
+
+        if WebConsole._control is not None and WebConsole._control.drive(steering, throttle):
+            WebConsole.set_taking_over(True)
+            return True
+
+        return False
+
+
     @staticmethod
     def set_taking_over(taking_over):
         WebConsole._taking_over = taking_over
@@ -246,13 +502,50 @@ class WebConsole(SocketServer.BaseRequestHandler):
         return AutoPilot.is_recording()
 
 
+    @staticmethod
+    def _get_jpeg(dashboard, view = "frame", quality = None, scale = 1.0):
+        # JPEG of a dashboard view as a memoryview, encoded at most once per dashboard, view, quality
+        # and scale for all endpoints, the cache only keeps the images of the latest dashboard
+        quality   = WebConsole._jpeg_quality_level if quality is None else quality
+        img       = dashboard.get(view, None)
+        timestamp = dashboard.get("timestamp", None)
+        key       = (timestamp, view, quality, scale)
+
+        if img is None:
+            return None
+
+        with WebConsole._jpeg_mutex:
+            if timestamp is not None and (WebConsole._jpeg_cache_timestamp is None or timestamp > WebConsole._jpeg_cache_timestamp):
+                WebConsole._jpeg_cache.clear()
+                WebConsole._jpeg_cache_timestamp = timestamp
+
+            if key in WebConsole._jpeg_cache:
+                return WebConsole._jpeg_cache[key]
+
+            if scale != 1.0:
+                img   = cv2.resize(img, None, fx = scale, fy = scale, interpolation = cv2.INTER_AREA)
+
+            ret, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            jpeg      = memoryview(jpeg.reshape(-1)) if ret else None
+
+            if jpeg is not None and timestamp is not None and timestamp == WebConsole._jpeg_cache_timestamp:
+                WebConsole._jpeg_cache[key] = jpeg
+
+            return jpeg
+
+
+    @staticmethod
+    def _get_blank_jpeg():
+        frame_width  = WebConsole._dashboard.get("frame_width" , 320)
+        frame_height = WebConsole._dashboard.get("frame_height", 240)
+        return memoryview(cv2.imencode('.jpg', np.zeros((frame_height, frame_width, 3), np.uint8))[1].reshape(-1))
+
+
     @staticmethod
     def _get_latest_frame():
-        frame = WebConsole._dashboard.get("frame", None)
+        frame = WebConsole._get_jpeg(WebConsole._dashboard, "frame")
         if frame is not None:
-            ret, frame = cv2.imencode('.jpg', frame , [cv2.IMWRITE_JPEG_QUALITY, WebConsole._jpeg_quality_level])
-            if ret:
-                WebConsole._last_frame = frame
+            WebConsole._last_frame = frame
 
         return frame
 
@@ -264,9 +557,7 @@ class WebConsole(SocketServer.BaseRequestHandler):
             frame = WebConsole._last_frame 
 
         if frame is None:
-            frame_width  = WebConsole._dashboard.get("frame_width" , 320)
-            frame_height = WebConsole._dashboard.get("frame_height", 240)
-            frame        = np.zeros((frame_width, frame_height, 3), np.uint8)
+            frame = WebConsole._get_blank_jpeg()
         return frame
 
 
@@ -287,28 +578,63 @@ class WebConsole(SocketServer.BaseRequestHandler):
                         f.write(frame)
                 return True
         except:
-            warn_exc("Unable to take snapshot %s in %s", filename, subdir) 
+            warn_exc("Unable to take snapshot %s in %s", filename, folder)
 
         return False
 
 
     @staticmethod
     def _get_track_view():
-        track_view = WebConsole._dashboard.get("track_view", None)
-
-        if track_view is not None:
-            ret, track_view = cv2.imencode('.jpg', track_view , [cv2.IMWRITE_JPEG_QUALITY, WebConsole._jpeg_quality_level])
-            if not ret:
-                track_view = None
+        track_view = WebConsole._get_jpeg(WebConsole._dashboard, "track_view")
 
         if track_view is None:
-            frame_width  = WebConsole._dashboard.get("frame_width" , 320)
-            frame_height = WebConsole._dashboard.get("frame_height", 240)
-            track_view   = np.zeros((frame_width, frame_height, 3), np.uint8)
+            track_view = WebConsole._get_blank_jpeg()
 
         return track_view
 
 
+    @staticmethod
+    def _set_dashboard(dashboard):
+        with WebConsole._dashboard_updated:
+            WebConsole._dashboard      = dashboard
+            WebConsole._dashboard_seq += 1
+            WebConsole._dashboard_updated.notify_all()
+
+
+    @staticmethod
+    def _wait_dashboard(last_seq, timeout):
+        # The dashboard newer than last_seq with its sequence number, or the current one after timeout
+        with WebConsole._dashboard_updated:
+            if WebConsole._dashboard_seq == last_seq:
+                WebConsole._dashboard_updated.wait(timeout)
+            return WebConsole._dashboard_seq, WebConsole._dashboard
+
+
+    @staticmethod
+    def _get_info(dashboard):
+        return {
+            "frame_width"    : dashboard.get("frame_width"    , 0   ),
+            "frame_height"   : dashboard.get("frame_height"   , 0   ),
+            "frame_rate"     : dashboard.get("frame_rate"     , 0.0 ),
+            "track_view_info": dashboard.get("track_view_info", None),
+            "focused_rect"   : dashboard.get("focused_rect"   , None),
+            "focused_nr_rect": dashboard.get("focused_nr_rect", None),
+            "go_motion_score": dashboard.get("go_motion_score", None),
+            "autodrive"      : "started" if AutoPilot.get_autodrive_started() else "stopped",
+            "drive_port"     : WebConsole.get_drive_port() if WebConsole._drive_server is not None else None,
+        }
+
+
+    @staticmethod
+    def _get_metrics():
+        server = WebConsole._http_server
+        metrics.set_gauge("webconsole_clients", server.get_client_count() if server is not None else 0)
+        metrics.set_gauge("webconsole_streams", server.get_stream_count() if server is not None else 0)
+        metrics.set_gauge("dashboard_frame_rate", WebConsole._dashboard.get("frame_rate", 0.0))
+        metrics.set_gauge("dashboard_last_process_seconds", WebConsole._dashboard.get("last_process_time", 0.0))
+        return metrics.snapshot()
+
+
     @staticmethod
     def _on_pre_observe_dashboard(dashboard):
         if WebConsole._taking_over:
@@ -318,7 +644,7 @@ class WebConsole(SocketServer.BaseRequestHandler):
                 WebConsole._taking_over_stared = None
 
         if WebConsole._taking_over:
-            WebConsole._dashboard = dashboard
+            WebConsole._set_dashboard(dashboard)
 
             if WebConsole.is_recording():
                 suffix = ",s={steering:+06.2f},t={throttle:+06.3f}".format(**WebConsole._drive_info)
@@ -330,7 +656,7 @@ class WebConsole(SocketServer.BaseRequestHandler):
     @staticmethod
     def _on_post_observe_dashboard(dashboard):
         if not WebConsole._taking_over:
-            WebConsole._dashboard = dashboard
+            WebConsole._set_dashboard(dashboard)
 
         return False
 
@@ -350,24 +676,80 @@ class WebConsole(SocketServer.BaseRequestHandler):
 
 
     def handle(self):
-        req  = []
-        path = None
+        # Serves the requests of one client connection, kept alive until the client closes it,
+        # it has been idle for keep_alive_seconds or a request fails
+        self._buffer     = b""
+        self._keep_alive = True
 
         try:
-            req = self.request.recv(1024).decode('iso8859-1').strip().split("\n")
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.request.settimeout(WebConsole._keep_alive_seconds)
+        except:
+            debug_exc("WebConsole: Unable to set socket options")
+
+        while self._keep_alive and WebConsole._state == WebConsole.STATE_STARTED:
+            req = self._read_request()
+            if req is None:
+                break
+
+            self._handle_request(req)
+
+
+    def _read_request(self):
+        # Header lines of the next request, None if the connection is closed, idle or the
+        # request exceeds _MAX_REQUEST_SIZE bytes
+        while True:
+            end = self._buffer.find(b"\r\n\r\n")
+            if end >= 0:
+                req, self._buffer = self._buffer[:end], self._buffer[end + 4:]
+                break
 
+            end = self._buffer.find(b"\n\n")
+            if end >= 0:
+                req, self._buffer = self._buffer[:end], self._buffer[end + 2:]
+                break
+
+            if len(self._buffer) >= WebConsole._MAX_REQUEST_SIZE:
+                self._keep_alive = False
+                self.send500("HTTP request too large")
+                return None
+
+            try:
+                data = self.request.recv(WebConsole._MAX_REQUEST_SIZE - len(self._buffer))
+            except (socket.timeout, socket.error, OSError):
+                return None
+
+            if not data:
+                return None
+
+            self._buffer += data
+
+        return [line.strip() for line in req.decode('iso8859-1').strip().split("\n")]
+
+
+    def _handle_request(self, req):
+        path    = None
+        headers = {}
+
+        try:
             if len(req) > 0 and req[0].upper().startswith("GET"):
                 uri, httpver = req[0].split(' ', 1)[1:][0].rsplit(' ', 1)
 
                 if len(httpver.strip()) == 8 and httpver.strip().upper().startswith("HTTP/") and httpver[6] == ".":
                     path = uri
 
+                    headers    = dict((k.strip().lower(), v.strip().lower()) for k, v in (line.split(":", 1) for line in req[1:] if ":" in line))
+                    connection = headers.get("connection", "")
+                    self._keep_alive = connection == "keep-alive" or (httpver.strip().upper() != "HTTP/1.0" and connection != "close")
+
         except:
             warn_exc("Unknown HTTP request:", req[0] if len(req) > 0 else "<empty>")
+            self._keep_alive = False
             self.send500("Unknown HTTP request")
             return
 
         if path == None:
+            self._keep_alive = False
             self.send500("Unrecognized HTTP request")
             return
 
@@ -377,16 +759,21 @@ class WebConsole(SocketServer.BaseRequestHandler):
             params = dict((q.split("=", 1) + [''])[:2] for q in result.query.strip().split("&"))
 
             if path == "/camera.jpg":
-                self.send200(self._get_any_frame().tostring(), "image/jpeg")
+                with WebConsole._image_slots:
+                    frame = self._get_any_frame()
+                self.send200(frame, "image/jpeg")
                 return
 
             if path == "/track_view.jpg":
-                self.send200(self._get_track_view().tostring(), "image/jpeg")
+                with WebConsole._image_slots:
+                    track_view = self._get_track_view()
+                self.send200(track_view, "image/jpeg")
                 return
 
             if path == "/photo":
                 photo_filename = "photo-%s.jpg" % (datetime.now().strftime("%Y%m%d-%H%M%S.%f"))
-                frame = self._get_any_frame()
+                with WebConsole._image_slots:
+                    frame = self._get_any_frame()
 
                 if self._snapshot_frame(WebConsole._snapshot_folder, photo_filename, frame = frame):
                     self.send200("""{"filename": "%s"}""" % photo_filename, "application/json")
@@ -404,105 +791,37 @@ class WebConsole(SocketServer.BaseRequestHandler):
                 return
 
             if path == '/live':
-                frame_width  = WebConsole._dashboard.get("frame_width" , 0)
-                frame_height = WebConsole._dashboard.get("frame_height", 0)
-
-                self.send200("""<html><head><script language="JavaScript"><!--\n"""
-                            """function refresh() {\n"""
-                            """ document.getElementById("track_view").src = "/track_view.jpg?" + Math.random();\n"""
-                            """ var camera = new Image();\n"""
-                            """ camera.onload = function() {\n"""
-                            """     var url = "/info";\n"""
-                            """     var request = new XMLHttpRequest();\n"""
-                            """     request.open("GET", url);\n"""
-                            """     request.onload = function(e) {\n"""
-                            """         if (request.readyState == 4 && request.status == 200 && request.getResponseHeader("content-type") ==="application/json") {\n"""
-                            """             result = JSON.parse(this.responseText);\n"""
-                            """             info = document.getElementById("info");\n"""
-                            """             info.innerText = "" + result.frame_width + "x" + result.frame_height + " @" + parseFloat(result.frame_rate).toFixed(2) + " fps [autodrive " + result.autodrive + "]";\n"""
-                            """             canvas        = document.getElementById("camera");\n"""
-                            """             canvas.width  = camera.width;\n"""
-                            """             canvas.height = camera.height;\n"""
-                            """             ctx           = canvas.getContext("2d");\n"""
-                            """             ctx.drawImage(camera, 0, 0);\n"""
-                            """             if (result.focused_rect) {\n"""
-                            """                 x1 = result.focused_rect[0];\n"""
-                            """                 y1 = result.focused_rect[1];\n"""
-                            """                 x2 = result.focused_rect[2];\n"""
-                            """                 y2 = result.focused_rect[3];\n"""
-                            """                 ctx.rect(x1, y1, x2, y2);\n"""
-                            """                 ctx.lineWidth   = 3;\n"""
-                            """                 ctx.strokeStyle = "red";\n"""
-                            """                 ctx.setLineDash([4, 2]);\n"""
-                            """                 ctx.stroke();\n"""
-                            """                 if (result.focused_nr_rect) {\n"""
-                            """                     ctx.font = "16px Arial";\n"""
-                            """                     ctx.fillStyle = "red";\n"""
-                            """                     ctx.fillText("#"+result.focused_nr_rect, x1 + 1, y1 + 17);\n"""
-                            """                 }\n"""
-                            """             }\n"""
-                            """             if (result.track_view_info) {\n"""
-                            """                 ctx.beginPath();\n"""
-                            """                 ctx.moveTo(0, result.track_view_info[0]);\n"""
-                            """                 ctx.lineTo(canvas.width, result.track_view_info[0]);\n"""
-                            """                 ctx.moveTo(0, result.track_view_info[1] - 1);\n"""
-                            """                 ctx.lineTo(canvas.width, result.track_view_info[1] - 1);\n"""
-                            """                 ctx.lineWidth   = 1;\n"""
-                            """                 ctx.strokeStyle = "yellow";\n"""
-                            """                 ctx.setLineDash([4, 2, 2, 2]);\n"""
-                            """                 ctx.stroke();\n"""
-                            """                 if (typeof(result.track_view_info[2]) == "number" && typeof(result.track_view_info[2]) != NaN) {\n"""
-                            """                     angle = (90.0 - parseFloat(result.track_view_info[2])) * Math.PI / 180.0;\n"""
-                            """                     r = (canvas.height - result.track_view_info[0]) * 0.9;\n"""
-                            """                     x = canvas.width/2 + r * Math.cos(angle);\n"""
-                            """                     y = canvas.height  - r * Math.sin(angle);\n"""
-                            """                     ctx.beginPath();\n"""
-                            """                     ctx.moveTo(canvas.width/2, canvas.height);\n"""
-                            """                     ctx.lineTo(x, y);\n"""
-                            """                     ctx.lineWidth   = 2;\n"""
-                            """                     ctx.strokeStyle = "magenta";\n"""
-                            """                     ctx.setLineDash([4, 2]);\n"""
-                            """                     ctx.stroke();\n"""
-                            """                 }\n"""
-                            """             }\n"""
-                            """         }\n"""
-                            """     }\n"""
-                            """     request.send(null);\n"""
-                            """ }\n"""
-                            """ camera.src = "/camera.jpg?" + Math.random();\n"""
-                            """ setTimeout("refresh()", %d);\n""" % (self._image_renew_interval) +
-                            """}\n"""
-                            """//--></script></head>\n"""
-                            """<body onload="setTimeout('refresh()', %d)">\n""" % (self._image_renew_interval) +
-                            """<center>"""
-                            """<canvas style="display:block" id="camera" width="%d" height="%d"></canvas>""" % (frame_width, frame_height) +
-                            """<div id="info">[]</div>"""
-                            """<img id="track_view" src="/track_view.jpg"/>"""
-                            """</center>\n"""
-                            """</body></html>\n"""
-                )
+                self.send200(self._get_live_page("poll" in params, "adaptive" in params))
+                return
+
+            if path == "/stream.mjpg":
+                self._send_stream(params.get("view", "frame"), "adaptive" in params)
+                return
+
+            if path == "/events":
+                self._send_events()
                 return
 
             if path == "/info":
-                self.send200(json.dumps({
-                    "frame_width"    : WebConsole._dashboard.get("frame_width"    , 0   ),
-                    "frame_height"   : WebConsole._dashboard.get("frame_height"   , 0   ),
-                    "frame_rate"     : WebConsole._dashboard.get("frame_rate"     , 0.0 ),
-                    "track_view_info": WebConsole._dashboard.get("track_view_info", None),
-                    "focused_rect"   : WebConsole._dashboard.get("focused_rect"   , None),
-                    "focused_nr_rect": WebConsole._dashboard.get("focused_nr_rect", None),
-                    "autodrive"      : "started" if AutoPilot.get_autodrive_started() else "stopped",
-                }), "application/json")
+                self.send200(json.dumps(self._get_info(WebConsole._dashboard)), "application/json")
+                return
+
+            if path == "/metrics":
+                if params.get("format", "") == "prometheus" or ("format" not in params and "text/plain" in headers.get("accept", "")):
+                    self.send200(metrics.to_prometheus(self._get_metrics()), "text/plain; version=0.0.4")
+                else:
+                    self.send200(json.dumps(self._get_metrics()), "application/json")
+                return
+
+            if path == "/telemetry":
+                self.send200(self._get_telemetry_page())
                 return
 
             if path == "/drive":
                 steering = float(params["steering"]) if "steering" in params else 0.0
                 throttle = float(params["throttle"]) if "throttle" in params else 0.0
-                WebConsole._drive_info = {"steering": steering, "throttle": throttle}
-
-                if self._control.drive(steering, throttle):
-                    self.set_taking_over(True)
 
+                if self._drive(steering, throttle):
                     self.send200(json.dumps({
                         "steering": steering,
                         "throttle": throttle,
@@ -534,46 +853,284 @@ class WebConsole(SocketServer.BaseRequestHandler):
             self.send500("Unsuccessful action: %s" % path)
 
 
-    def send200(self, content, content_type = "text/html"):
+    def _get_live_page(self, poll, adaptive):
+        # Live view: the camera and track view MJPEG streams with the overlay redrawn on every
+        # /events message, adaptive streams with ?adaptive, or polling /camera.jpg, /track_view.jpg
+        # and /info with ?poll
+        frame_width  = WebConsole._dashboard.get("frame_width" , 0)
+        frame_height = WebConsole._dashboard.get("frame_height", 0)
+        frame_size   = ' width="%d" height="%d"' % (frame_width, frame_height) if frame_width > 0 and frame_height > 0 else ""
+
+        return ("""<html><head><script language="JavaScript"><!--\n"""
+                """function overlay(result) {\n"""
+                """ info = document.getElementById("info");\n"""
+                """ info.innerText = "" + result.frame_width + "x" + result.frame_height + " @" + parseFloat(result.frame_rate).toFixed(2) + " fps [autodrive " + result.autodrive + "]";\n"""
+                """ if (typeof(result.go_motion_score) == "number") {\n"""
+                """     info.innerText += " [motion " + (result.go_motion_score * 100).toFixed(1) + "%%]";\n"""
+                """ }\n"""
+                """ camera        = document.getElementById("camera");\n"""
+                """ canvas        = document.getElementById("overlay");\n"""
+                """ canvas.width  = camera.naturalWidth  || result.frame_width  || camera.width;\n"""
+                """ canvas.height = camera.naturalHeight || result.frame_height || camera.height;\n"""
+                """ ctx           = canvas.getContext("2d");\n"""
+                """ if (result.focused_rect) {\n"""
+                """     x1 = result.focused_rect[0];\n"""
+                """     y1 = result.focused_rect[1];\n"""
+                """     x2 = result.focused_rect[2];\n"""
+                """     y2 = result.focused_rect[3];\n"""
+                """     ctx.rect(x1, y1, x2, y2);\n"""
+                """     ctx.lineWidth   = 3;\n"""
+                """     ctx.strokeStyle = "red";\n"""
+                """     ctx.setLineDash([4, 2]);\n"""
+                """     ctx.stroke();\n"""
+                """     if (result.focused_nr_rect) {\n"""
+                """         ctx.font = "16px Arial";\n"""
+                """         ctx.fillStyle = "red";\n"""
+                """         ctx.fillText("#"+result.focused_nr_rect, x1 + 1, y1 + 17);\n"""
+                """     }\n"""
+                """ }\n"""
+                """ if (result.track_view_info) {\n"""
+                """     ctx.beginPath();\n"""
+                """     ctx.moveTo(0, result.track_view_info[0]);\n"""
+                """     ctx.lineTo(canvas.width, result.track_view_info[0]);\n"""
+                """     ctx.moveTo(0, result.track_view_info[1] - 1);\n"""
+                """     ctx.lineTo(canvas.width, result.track_view_info[1] - 1);\n"""
+                """     ctx.lineWidth   = 1;\n"""
+                """     ctx.strokeStyle = "yellow";\n"""
+                """     ctx.setLineDash([4, 2, 2, 2]);\n"""
+                """     ctx.stroke();\n"""
+                """     if (typeof(result.track_view_info[2]) == "number" && typeof(result.track_view_info[2]) != NaN) {\n"""
+                """         angle = (90.0 - parseFloat(result.track_view_info[2])) * Math.PI / 180.0;\n"""
+                """         r = (canvas.height - result.track_view_info[0]) * 0.9;\n"""
+                """         x = canvas.width/2 + r * Math.cos(angle);\n"""
+                """         y = canvas.height  - r * Math.sin(angle);\n"""
+                """         ctx.beginPath();\n"""
+                """         ctx.moveTo(canvas.width/2, canvas.height);\n"""
+                """         ctx.lineTo(x, y);\n"""
+                """         ctx.lineWidth   = 2;\n"""
+                """         ctx.strokeStyle = "magenta";\n"""
+                """         ctx.setLineDash([4, 2]);\n"""
+                """         ctx.stroke();\n"""
+                """     }\n"""
+                """ }\n"""
+                """}\n"""
+                """function refresh() {\n"""
+                """ document.getElementById("track_view").src = "/track_view.jpg?" + Math.random();\n"""
+                """ var camera = document.getElementById("camera");\n"""
+                """ camera.onload = function() {\n"""
+                """     var request = new XMLHttpRequest();\n"""
+                """     request.open("GET", "/info");\n"""
+                """     request.onload = function(e) {\n"""
+                """         if (request.readyState == 4 && request.status == 200 && request.getResponseHeader("content-type") ==="application/json") {\n"""
+                """             overlay(JSON.parse(this.responseText));\n"""
+                """         }\n"""
+                """     }\n"""
+                """     request.send(null);\n"""
+                """ }\n"""
+                """ camera.src = "/camera.jpg?" + Math.random();\n"""
+                """ setTimeout("refresh()", %(interval)d);\n"""
+                """}\n"""
+                """function start() {\n"""
+                """ if (%(poll)s) {\n"""
+                """     refresh();\n"""
+                """     return;\n"""
+                """ }\n"""
+                """ document.getElementById("camera").src     = "/stream.mjpg?view=frame%(adaptive)s";\n"""
+                """ document.getElementById("track_view").src = "/stream.mjpg?view=track_view%(adaptive)s";\n"""
+                """ var events = new EventSource("/events");\n"""
+                """ events.onmessage = function(e) { overlay(JSON.parse(e.data)); };\n"""
+                """}\n"""
+                """//--></script></head>\n"""
+                """<body onload="start()">\n"""
+                """<center>"""
+                """<div style="position:relative; display:inline-block">"""
+                """<img style="display:block" id="camera"%(size)s/>"""
+                """<canvas style="position:absolute; left:0; top:0" id="overlay"%(size)s></canvas>"""
+                """</div>"""
+                """<div id="info">[]</div>"""
+                """<img id="track_view"/>"""
+                """</center>\n"""
+                """</body></html>\n""") % {"interval": self._image_renew_interval, "poll": "true" if poll else "false", "adaptive": "&adaptive" if adaptive else "", "size": frame_size}
+
+
+    def _get_telemetry_page(self):
+        # Live telemetry tables of /metrics, polled every second
+        return ("""<html><head><style>\n"""
+                """body { font-family: monospace; }\n"""
+                """table { border-collapse: collapse; margin-bottom: 1em; }\n"""
+                """td, th { border: 1px solid #ccc; padding: 2px 8px; text-align: right; }\n"""
+                """th:first-child, td:first-child { text-align: left; }\n"""
+                """</style><script language="JavaScript"><!--\n"""
+                """function labels(v) {\n"""
+                """ var text = [];\n"""
+                """ for (var k in v.labels) text.push(k + "=" + v.labels[k]);\n"""
+                """ return text.join(",");\n"""
+                """}\n"""
+                """function ms(s) { return (s * 1000.0).toFixed(2); }\n"""
+                """function table(title, columns, rows) {\n"""
+                """ var html = "<h3>" + title + "</h3><table><tr><th>" + columns.join("</th><th>") + "</th></tr>";\n"""
+                """ for (var i = 0; i < rows.length; i++) html += "<tr><td>" + rows[i].join("</td><td>") + "</td></tr>";\n"""
+                """ return html + "</table>";\n"""
+                """}\n"""
+                """function render(result) {\n"""
+                """ var timings = [], counters = [], gauges = [], threads = [], name, i, v;\n"""
+                """ for (name in result.timings) for (i = 0; i < result.timings[name].length; i++) {\n"""
+                """     v = result.timings[name][i];\n"""
+                """     timings.push([name, labels(v), v.count, ms(v.last), ms(v.avg), ms(v.max)]);\n"""
+                """ }\n"""
+                """ for (name in result.counters) for (i = 0; i < result.counters[name].length; i++) {\n"""
+                """     v = result.counters[name][i];\n"""
+                """     counters.push([name, labels(v), v.value]);\n"""
+                """ }\n"""
+                """ for (name in result.gauges) for (i = 0; i < result.gauges[name].length; i++) {\n"""
+                """     v = result.gauges[name][i];\n"""
+                """     gauges.push([name, labels(v), typeof(v.value) == "number" ? +v.value.toFixed(4) : v.value]);\n"""
+                """ }\n"""
+                """ for (name in result.system.threads) {\n"""
+                """     v = result.system.threads[name];\n"""
+                """     threads.push([name, v.cpu_seconds.toFixed(2), v.cpu_usage == null ? "-" : (v.cpu_usage * 100).toFixed(1)]);\n"""
+                """ }\n"""
+                """ timings.sort(); counters.sort(); gauges.sort(); threads.sort();\n"""
+                """ var system = result.system;\n"""
+                """ document.getElementById("system").innerText =\n"""
+                """     "RSS " + (system.memory_rss_bytes == null ? "-" : (system.memory_rss_bytes / 1048576).toFixed(1) + " MB") +\n"""
+                """     "  temperature " + (system.temperature_celsius == null ? "-" : system.temperature_celsius.toFixed(1) + " C") +\n"""
+                """     "  load " + (system.load_average == null ? "-" : system.load_average.toFixed(2));\n"""
+                """ document.getElementById("tables").innerHTML =\n"""
+                """     table("Latencies (ms)", ["name", "labels", "count", "last", "avg", "max"], timings) +\n"""
+                """     table("Counters", ["name", "labels", "value"], counters) +\n"""
+                """     table("Gauges", ["name", "labels", "value"], gauges) +\n"""
+                """     table("Threads", ["thread", "cpu seconds", "cpu %%"], threads);\n"""
+                """}\n"""
+                """function refresh() {\n"""
+                """ var request = new XMLHttpRequest();\n"""
+                """ request.open("GET", "/metrics");\n"""
+                """ request.onload = function(e) {\n"""
+                """     if (request.readyState == 4 && request.status == 200) {\n"""
+                """         render(JSON.parse(this.responseText));\n"""
+                """     }\n"""
+                """     setTimeout("refresh()", %(interval)d);\n"""
+                """ }\n"""
+                """ request.onerror = function(e) { setTimeout("refresh()", %(interval)d); }\n"""
+                """ request.send(null);\n"""
+                """}\n"""
+                """//--></script></head>\n"""
+                """<body onload="refresh()">\n"""
+                """<div id="system"></div>\n"""
+                """<div id="tables"></div>\n"""
+                """</body></html>\n""") % {"interval": 1000}
+
+
+    def _send_stream_header(self, content_type):
+        self._keep_alive = False
+
+        if not self.server.start_stream(self.request):
+            warn("WebConsole: too many streams, rejected %s", repr(self.client_address))
+            self._send_response("503 Service Unavailable", "<html><body>Too many streams</body></html>", "text/html")
+            return False
+
+        header = "HTTP/1.1 200 OK\r\nContent-Type: %s\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n" % content_type
+        self.request.sendall(header.encode('iso8859-1'))
+        return True
+
+
+    def _send_stream(self, view, adaptive = False):
+        # multipart/x-mixed-replace MJPEG stream pushing every new dashboard view once, adaptive
+        # streams are paced and scaled to the client by AdaptivePreview
+        if view not in WebConsole._stream_views:
+            self.send404("Unknown view: %s" % view)
+            return
+
         try:
-            if bytes is not str and type(content) is str:
-                content = content.encode('iso8859-1')
+            if not self._send_stream_header("multipart/x-mixed-replace; boundary=frame"):
+                return
 
-            self.request.sendall(b'HTTP/1.0 200 OK\nContent-Type: %s\n\n%s' % (content_type.encode('iso8859-1'), content))
-        except OSError: #ConnectionResetError (py3), BrokenPipeError (py3)
-            pass
-        except socket.error:
+            last_seq = None
+            preview  = AdaptivePreview(self.request, WebConsole._preview_bandwidth * 125, WebConsole._preview_min_fps) if adaptive else None
+
+            while WebConsole._state == WebConsole.STATE_STARTED:
+                seq, dashboard = WebConsole._wait_dashboard(last_seq, 1.0)
+                if seq == last_seq:
+                    continue
+
+                last_seq = seq
+                if preview is not None and not preview.is_due(monotonic()):
+                    continue
+
+                quality, scale = preview.get_level() if preview is not None else (None, 1.0)
+                jpeg = WebConsole._get_jpeg(dashboard, view, quality, scale)
+                if jpeg is None:
+                    continue
+
+                start = monotonic()
+                self.request.sendall(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" % len(jpeg))
+                self.request.sendall(jpeg)
+                self.request.sendall(b"\r\n")
+
+                if preview is not None:
+                    preview.update(len(jpeg), start, monotonic())
+
+        except (socket.error, OSError): #ConnectionResetError (py3), BrokenPipeError (py3)
             pass
-        except:
-            debug_exc("WebConsole: send200 exception")
 
 
-    def send404(self, content):
+    def _send_events(self):
+        # Server-sent events carrying the /info of every new dashboard
         try:
-            if content[0] != "<":
-                content = "<html><body>%s</body></html>"
-            
-            self.request.sendall(b'HTTP/1.0 404 Not Found\nContent-Type: text/html\n\n%s' % (content.encode('iso8859-1')))
-        except OSError: #ConnectionResetError (py3), BrokenPipeError (py3)
-            pass
-        except socket.error:
+            if not self._send_stream_header("text/event-stream"):
+                return
+
+            last_seq = None
+
+            while WebConsole._state == WebConsole.STATE_STARTED:
+                seq, dashboard = WebConsole._wait_dashboard(last_seq, 1.0)
+                if seq == last_seq:
+                    continue
+
+                last_seq = seq
+                self.request.sendall(("data: %s\n\n" % json.dumps(self._get_info(dashboard))).encode('iso8859-1'))
+
+        except (socket.error, OSError): #ConnectionResetError (py3), BrokenPipeError (py3)
             pass
-        except:
-            debug_exc("WebConsole: send404 exception")
 
 
-    def send500(self, content):
+    def _send_response(self, status, content, content_type):
         try:
-            if content[0] != "<":
-                content = "<html><body>%s</body></html>"
-            
-            self.request.sendall(b'HTTP/1.0 500 ERROR\nContent-Type: text/html\n\n%s' % (content.encode('iso8859-1')))
+            if bytes is not str and type(content) is str:
+                content = content.encode('iso8859-1')
+
+            header = "HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+                         status, content_type, len(content), "keep-alive" if self._keep_alive else "close")
+            self.request.sendall(header.encode('iso8859-1'))
+            self.request.sendall(content)
+            return True
         except OSError: #ConnectionResetError (py3), BrokenPipeError (py3)
             pass
         except socket.error:
             pass
         except:
-            debug_exc("WebConsole: send500 exception")
+            debug_exc("WebConsole: send %s exception", status)
+
+        self._keep_alive = False
+        return False
+
+
+    def send200(self, content, content_type = "text/html"):
+        return self._send_response("200 OK", content, content_type)
+
+
+    def send404(self, content):
+        if content[0] != "<":
+            content = "<html><body>%s</body></html>" % content
+
+        return self._send_response("404 Not Found", content, "text/html")
+
+
+    def send500(self, content):
+        if content[0] != "<":
+            content = "<html><body>%s</body></html>" % content
+
+        return self._send_response("500 ERROR", content, "text/html")
 
 
 if __name__ == "__main__":